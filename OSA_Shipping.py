@@ -1,10 +1,16 @@
 import streamlit as st
-import requests
 import pandas as pd
-from datetime import datetime, timedelta
-import h3
-import numpy as np
-from odp.client import OdpClient
+from ais_core import (
+    DEFAULT_FETCH_WORKERS,
+    AisFetchError,
+    AisTrackFetcher,
+    TokenManager,
+    get_track_store,
+    last_days_window,
+    osa_hex_shannon,
+    trajectory_segments,
+    trajectory_summary,
+)
 
 st.title("AIS Data Analyzer")
 
@@ -12,74 +18,123 @@ st.title("AIS Data Analyzer")
 CLIENT_ID = st.sidebar.text_input("Client ID", "CLIENT_ID") # enter client ID
 CLIENT_SECRET = st.sidebar.text_input("Client Secret", "CLIENT_SECRET!", type="password") #enter client secret
 
-AUTH_URL = "https://id.barentswatch.no/connect/token"
-
-auth_data = {
-    "client_id": CLIENT_ID,
-    "client_secret": CLIENT_SECRET,
-    "grant_type": "client_credentials",
-    "scope": "ais"
-}
-
-@st.cache_data
-def get_access_token():
-    response = requests.post(AUTH_URL, data=auth_data)
-    if response.status_code == 200:
-        return response.json()["access_token"]
+# One token manager per set of credentials, shared by reruns and fetch workers
+@st.cache_resource
+def get_token_manager(client_id, client_secret):
+    return TokenManager(client_id, client_secret)
+
+token_manager = get_token_manager(CLIENT_ID, CLIENT_SECRET)
+try:
+    token = token_manager.token()
+except AisFetchError as e:
+    st.error(str(e))
+    token = None
+
+# Render the report for one vessel's track (newest position first). The
+# movement summary is filled in once the whole fleet has been analysed.
+def show_vessel_report(mmsi, df):
+    st.subheader(f"Report for MMSI: {mmsi}")
+    st.write(f"Number of data points: {len(df)}")
+
+    if not df.empty:
+        st.write("Latest position:")
+        latest = df.iloc[0]
+        st.write(f"Latitude: {latest['latitude']}, Longitude: {latest['longitude']}")
+        st.write(f"Time: {latest['msgtime']}")
+        st.write(f"Speed: {latest['speedOverGround']} knots")
+        st.write(f"Course: {latest['courseOverGround']}°")
+
+        st.write("Movement summary:")
+        movement_summary = st.empty()
+
+        st.write("Position plot:")
+        st.map(df[['latitude', 'longitude']])
+        return movement_summary
     else:
-        st.error(f"Authentication Error: {response.status_code} - {response.text}")
+        st.write("No data available for this MMSI in the given time range.")
         return None
 
-token = get_access_token()
+def show_movement_summary(placeholder, row, avg_speed):
+    with placeholder.container():
+        st.write(f"Total distance traveled: {row['distance_km']:.2f} km over {row['duration_h']:.1f} hours")
+        st.write(f"Average speed: {avg_speed:.2f} knots")
+        if pd.notna(row['avg_speed_kn']):
+            st.write(f"Average speed over the track: {row['avg_speed_kn']:.2f} knots")
+        if 'high_biodiversity_h' in row:
+            st.write(
+                f"Inside high biodiversity OSA areas: {row['high_biodiversity_h']:.1f} hours, "
+                f"{row['high_biodiversity_km']:.2f} km ({int(row['osa_hexes'])} OSA hexes visited)"
+            )
 
 if token:
     # User input for MMSI numbers
     mmsi_input = st.text_area("Enter MMSI numbers (one per line):")
     mmsi_list = [int(mmsi.strip()) for mmsi in mmsi_input.split("\n") if mmsi.strip()]
 
+    # Number of track requests in flight at once
+    fetch_workers = st.sidebar.slider("Parallel requests", min_value=1, max_value=32, value=DEFAULT_FETCH_WORKERS)
+
+    # Keep fetched positions locally and only fetch what is new since the last run
+    use_store = st.sidebar.checkbox(
+        "Use local track store",
+        value=True,
+        help="Reuse positions fetched by previous runs and only request newer ones"
+    )
+    if st.sidebar.button("Clear track store"):
+        get_track_store().clear()
+        st.sidebar.success("Track store cleared")
+
+    # Join the tracks against the Ocean Sensitive Areas dataset
+    osa_exposure = st.sidebar.checkbox(
+        "Ocean Sensitive Area exposure",
+        value=True,
+        help="Report time and distance spent in high biodiversity OSA hexes (fetches uncached hexes from HUB Ocean)"
+    )
+
     if st.button("Generate Reports"):
-        for mmsi in mmsi_list:
-            st.subheader(f"Report for MMSI: {mmsi}")
-
-            now = datetime.utcnow()
-            seven_days_ago = now - timedelta(days=7)
-            from_date = seven_days_ago.strftime("%Y-%m-%dT%H:%M:%SZ")
-            to_date = now.strftime("%Y-%m-%dT%H:%M:%SZ")
-
-            API_URL = f"https://historic.ais.barentswatch.no/v1/historic/tracks/{mmsi}/{from_date}/{to_date}"
-            headers = {"Authorization": f"Bearer {token}"}
-
-            response = requests.get(API_URL, headers=headers)
-
-            if response.status_code == 200:
-                ais_data = response.json()
-                df = pd.json_normalize(ais_data)
-
-                st.write(f"Number of data points: {len(df)}")
-
-                if not df.empty:
-                    st.write("Latest position:")
-                    latest = df.iloc[0]
-                    st.write(f"Latitude: {latest['latitude']}, Longitude: {latest['longitude']}")
-                    st.write(f"Time: {latest['msgtime']}")
-                    st.write(f"Speed: {latest['speedOverGround']} knots")
-                    st.write(f"Course: {latest['courseOverGround']}°")
-
-                    st.write("Movement summary:")
-                    total_distance = df['speedOverGround'].sum() * 1852 / 3600  # Convert knots to meters
-                    st.write(f"Total distance traveled: {total_distance:.2f} meters")
-                    
-                    avg_speed = df['speedOverGround'].mean()
-                    st.write(f"Average speed: {avg_speed:.2f} knots")
-
-                    st.write("Position plot:")
-                    st.map(df[['latitude', 'longitude']])
-                else:
-                    st.write("No data available for this MMSI in the given time range.")
-            else:
-                st.error(f"Error fetching data: {response.status_code} - {response.text}")
+        start, end = last_days_window(days=7)
+        fetcher = AisTrackFetcher(token_manager, max_workers=fetch_workers)
+        store = get_track_store() if use_store else None
+        progress_bar = st.progress(0)
+
+        # Reports appear as each vessel's track completes
+        tracks, summary_slots, avg_speeds = [], {}, {}
+        for done, (mmsi, df, error) in enumerate(fetcher.iter_fleet(mmsi_list, start, end, store), start=1):
+            progress_bar.progress(done / len(set(mmsi_list)))
+            if error is not None:
+                st.subheader(f"Report for MMSI: {mmsi}")
+                st.error(error)
+                continue
+
+            placeholder = show_vessel_report(mmsi, df)
+            if placeholder is not None:
+                tracks.append(df.assign(mmsi=mmsi))
+                summary_slots[mmsi] = placeholder
+                avg_speeds[mmsi] = df['speedOverGround'].mean()
+
+        if store is not None:
+            store.prune()
+
+        # Movement analytics for the whole fleet in one pass
+        if tracks:
+            segments = trajectory_segments(pd.concat(tracks, ignore_index=True))
+
+            hex_shannon = None
+            if osa_exposure:
+                with st.spinner("Joining tracks against Ocean Sensitive Areas..."):
+                    try:
+                        hex_shannon = osa_hex_shannon(segments['h3_index'].to_numpy(), on_warning=st.warning)
+                    except Exception as e:
+                        st.warning(f"Ocean Sensitive Area exposure unavailable: {e}")
+
+            summary = trajectory_summary(segments, hex_shannon)
+            for mmsi, placeholder in summary_slots.items():
+                if mmsi in summary.index:
+                    show_movement_summary(placeholder, summary.loc[mmsi], avg_speeds[mmsi])
+
+            st.subheader("Fleet movement summary")
+            st.dataframe(summary)
 
     st.sidebar.info("This app fetches AIS data for the past 7 days for each MMSI number provided.")
 else:
-    st.error("Please provide valid authentication credentials.")
-
+    st.error("Please provide valid authentication credentials.")
\ No newline at end of file
@@ -0,0 +1,547 @@
+"""
+BarentsWatch AIS track fetching for the AIS Data Analyzer (OSA_Shipping.py),
+independent of Streamlit.
+
+Historic tracks are fetched concurrently over one pooled HTTP session. Long
+time windows are split into sub-range requests, rate limiting (429) and
+transient server errors are retried with backoff, and vessels are yielded
+as soon as all of their sub-ranges have arrived. The bearer token is
+refreshed before it expires and after any 401 response. Fetched positions
+are kept in a local SQLite track store, so later runs only fetch what is new.
+
+Trajectory analytics (distances, durations and time spent in high
+biodiversity Ocean Sensitive Area hexes) run over all vessels at once.
+"""
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from osa_core import (
+    OSA_DATASET_ID,
+    cells_to_str,
+    fetch_hex_rows,
+    get_hex_cache,
+    haversine_km,
+    latlng_to_cells,
+    str_to_cells,
+)
+
+logger = logging.getLogger(__name__)
+
+AUTH_URL = "https://id.barentswatch.no/connect/token"
+AIS_TRACKS_URL = "https://historic.ais.barentswatch.no/v1/historic/tracks/{mmsi}/{from_date}/{to_date}"
+AIS_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Concurrency, sub-range and retry settings for historic track requests
+DEFAULT_FETCH_WORKERS = 8
+MAX_WINDOW_SPAN = timedelta(days=1)
+FETCH_TIMEOUT_S = (5, 60)  # (connect, read)
+FETCH_MAX_RETRIES = 4
+FETCH_RETRY_BACKOFF_S = 1.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Local store of fetched positions, one row per (mmsi, message time)
+AIS_STORE_PATH = os.environ.get(
+    "AIS_STORE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "osa", "ais_tracks.sqlite")
+)
+AIS_STORE_RETENTION = timedelta(days=30)
+# Late-arriving messages: refetch this much before a vessel's stored coverage ends
+AIS_STORE_OVERLAP = timedelta(minutes=15)
+TRACK_COLUMNS = ['msgtime', 'latitude', 'longitude', 'speedOverGround', 'courseOverGround']
+
+# Tokens are refreshed this long before they expire
+TOKEN_REFRESH_MARGIN_S = 60
+DEFAULT_TOKEN_LIFETIME_S = 3600
+
+class AisFetchError(Exception):
+    """
+    A track request that failed for good, with the HTTP status if any.
+    """
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class AisAuthError(AisFetchError):
+    """
+    The token endpoint rejected the client credentials.
+    """
+
+class TokenManager:
+    """
+    Holds a BarentsWatch client credentials token and refreshes it
+    refresh_margin_s before it expires (per expires_in), so long runs never
+    send an expired token. Thread safe: concurrent workers share the token
+    and only one of them refreshes it at a time.
+    """
+    def __init__(self, client_id, client_secret, scope="ais", auth_url=AUTH_URL, session=None,
+                 refresh_margin_s=TOKEN_REFRESH_MARGIN_S):
+        self.auth_data = {
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "grant_type": "client_credentials",
+            "scope": scope
+        }
+        self.auth_url = auth_url
+        self.refresh_margin_s = refresh_margin_s
+        self.session = session if session is not None else requests.Session()
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+    
+    def _fetch(self):
+        try:
+            response = self.session.post(self.auth_url, data=self.auth_data, timeout=FETCH_TIMEOUT_S)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise AisAuthError(f"Authentication Error: {e}") from e
+        
+        if response.status_code != 200:
+            raise AisAuthError(
+                f"Authentication Error: {response.status_code} - {response.text}", response.status_code
+            )
+        
+        payload = response.json()
+        self._token = payload["access_token"]
+        self._expires_at = time.monotonic() + float(payload.get("expires_in", DEFAULT_TOKEN_LIFETIME_S))
+    
+    def token(self):
+        """
+        Returns a token that is valid for at least refresh_margin_s more,
+        fetching a new one first if needed. Raises AisAuthError.
+        """
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._expires_at - self.refresh_margin_s:
+                self._fetch()
+            return self._token
+    
+    def refresh(self, rejected_token):
+        """
+        Replaces a token the server rejected (401) and returns the new one.
+        When another worker already replaced it, its token is reused.
+        """
+        with self._lock:
+            if self._token == rejected_token:
+                self._fetch()
+            return self._token
+
+def make_session(pool_size=DEFAULT_FETCH_WORKERS):
+    """
+    Returns a requests.Session whose connection pool fits pool_size
+    concurrent requests, so connections are reused across requests.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def split_window(start, end, max_span=MAX_WINDOW_SPAN):
+    """
+    Splits [start, end] into consecutive sub-ranges of at most max_span.
+    """
+    windows = []
+    while start < end:
+        stop = min(start + max_span, end)
+        windows.append((start, stop))
+        start = stop
+    return windows
+
+def retry_after_s(response, attempt):
+    """
+    Seconds to wait before retrying a response: the server's Retry-After
+    header when it gives one in seconds, else exponential backoff.
+    """
+    header = response.headers.get("Retry-After") if response is not None else None
+    if header is not None:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            pass
+    return FETCH_RETRY_BACKOFF_S * 2 ** attempt
+
+def tracks_to_frame(records):
+    """
+    Builds the track DataFrame from the flat JSON records, newest position first.
+    """
+    df = pd.DataFrame.from_records(records)
+    if df.empty or 'msgtime' not in df.columns:
+        return df
+    
+    # Sub-ranges share their boundary timestamp, so drop repeated messages
+    df = df.drop_duplicates(subset=['msgtime'])
+    order = pd.to_datetime(df['msgtime'], utc=True, errors='coerce').sort_values(ascending=False, kind='stable')
+    return df.loc[order.index].reset_index(drop=True)
+
+class AisTrackStore:
+    """
+    SQLite-backed store of AIS positions, indexed by (mmsi, message time).
+    The report columns are stored typed and any other message fields as
+    JSON. For every vessel the store remembers the time span its track has
+    been fetched for, so later runs only request the window after that.
+    Positions older than the retention period are pruned.
+    """
+    def __init__(self, path=AIS_STORE_PATH, retention=AIS_STORE_RETENTION):
+        self.retention = retention
+        self._lock = threading.Lock()
+        
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS positions (
+                mmsi INTEGER NOT NULL,
+                epoch REAL NOT NULL,
+                msgtime TEXT NOT NULL,
+                latitude REAL,
+                longitude REAL,
+                speedOverGround REAL,
+                courseOverGround REAL,
+                extra TEXT,
+                PRIMARY KEY (mmsi, epoch)
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS vessels (
+                mmsi INTEGER PRIMARY KEY,
+                fetched_from REAL NOT NULL,
+                fetched_until REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+    
+    def fetch_start(self, mmsi, start):
+        """
+        Returns where fetching a vessel's track from start can resume: just
+        before the end of its stored coverage when that covers start, or
+        start itself.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT fetched_from, fetched_until FROM vessels WHERE mmsi = ?", (mmsi,)
+            ).fetchone()
+        if row is None or not row[0] <= start.timestamp() <= row[1]:
+            return start
+        
+        resume = datetime.fromtimestamp(row[1], timezone.utc) - AIS_STORE_OVERLAP
+        return max(start, resume)
+    
+    def add(self, mmsi, records, fetched_from, fetched_until):
+        """
+        Merges the records fetched for [fetched_from, fetched_until] into the
+        store, replacing repeated messages, and extends the vessel's fetched
+        span (or restarts it when the new window does not connect to it).
+        """
+        df = tracks_to_frame(records)
+        entries = []
+        if not df.empty:
+            epoch = pd.to_datetime(df['msgtime'], utc=True, errors='coerce')
+            df = df[epoch.notna()]
+            epoch = epoch[epoch.notna()].astype('int64').to_numpy() / 1e9
+            
+            extra_columns = [col for col in df.columns if col not in TRACK_COLUMNS]
+            extra = (
+                [json.dumps(record, default=str) for record in df[extra_columns].to_dict('records')]
+                if extra_columns else [None] * len(df)
+            )
+            typed = df.reindex(columns=TRACK_COLUMNS)
+            entries = [
+                (mmsi, float(e), *row, x)
+                for e, row, x in zip(epoch, typed.itertuples(index=False, name=None), extra)
+            ]
+        
+        span_from, span_until = fetched_from.timestamp(), fetched_until.timestamp()
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO positions VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entries)
+            
+            row = self._conn.execute(
+                "SELECT fetched_from, fetched_until FROM vessels WHERE mmsi = ?", (mmsi,)
+            ).fetchone()
+            if row is not None and row[0] <= span_from <= row[1]:
+                span_from, span_until = row[0], max(row[1], span_until)
+            self._conn.execute("INSERT OR REPLACE INTO vessels VALUES (?, ?, ?)", (mmsi, span_from, span_until))
+            self._conn.commit()
+    
+    def read(self, mmsi, start, end):
+        """
+        Returns a vessel's stored positions between start and end, newest first.
+        """
+        with self._lock:
+            df = pd.read_sql_query(
+                f"SELECT {', '.join(TRACK_COLUMNS)} FROM positions "
+                "WHERE mmsi = ? AND epoch BETWEEN ? AND ? ORDER BY epoch DESC",
+                self._conn,
+                params=(mmsi, start.timestamp(), end.timestamp())
+            )
+        return df
+    
+    def prune(self, now=None):
+        """
+        Drops positions older than the retention period.
+        """
+        cutoff = (now or datetime.now(timezone.utc)) - self.retention
+        with self._lock:
+            self._conn.execute("DELETE FROM positions WHERE epoch < ?", (cutoff.timestamp(),))
+            self._conn.execute("DELETE FROM vessels WHERE fetched_until < ?", (cutoff.timestamp(),))
+            self._conn.execute("UPDATE vessels SET fetched_from = MAX(fetched_from, ?)", (cutoff.timestamp(),))
+            self._conn.commit()
+    
+    def clear(self):
+        """
+        Removes every stored position and fetch record.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM positions")
+            self._conn.execute("DELETE FROM vessels")
+            self._conn.commit()
+
+@functools.lru_cache(maxsize=None)
+def get_track_store():
+    """
+    Opens the on-disk AIS track store once per process.
+    """
+    return AisTrackStore()
+
+class AisTrackFetcher:
+    """
+    Fetches historic AIS tracks for a fleet over one pooled session with at
+    most max_workers requests in flight. A 429 response pauses every worker
+    until the server's Retry-After has passed, not just the one that got it.
+    Tokens come from the shared TokenManager.
+    """
+    def __init__(self, tokens, max_workers=DEFAULT_FETCH_WORKERS, max_span=MAX_WINDOW_SPAN, session=None,
+                 timeout=FETCH_TIMEOUT_S):
+        self.tokens = tokens
+        self.max_workers = max_workers
+        self.max_span = max_span
+        self.timeout = timeout
+        self.session = session if session is not None else make_session(max_workers)
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+    
+    def _wait_for_rate_limit(self):
+        with self._lock:
+            delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    
+    def _pause(self, delay_s):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay_s)
+    
+    def fetch_window(self, mmsi, start, end):
+        """
+        Fetches the track records of one vessel for one time window,
+        retrying rate limited, failed and timed out requests with backoff.
+        A 401 response refreshes the token and retries once. Raises
+        AisFetchError once the retries are used up or on any other error
+        status.
+        """
+        url = AIS_TRACKS_URL.format(
+            mmsi=mmsi, from_date=start.strftime(AIS_TIME_FORMAT), to_date=end.strftime(AIS_TIME_FORMAT)
+        )
+        token = self.tokens.token()
+        refreshed = False
+        
+        attempt = 0
+        while True:
+            self._wait_for_rate_limit()
+            try:
+                response = self.session.get(
+                    url, headers={"Authorization": f"Bearer {token}"}, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == FETCH_MAX_RETRIES:
+                    raise AisFetchError(f"Error fetching data: {e}") from e
+                time.sleep(FETCH_RETRY_BACKOFF_S * 2 ** attempt)
+                attempt += 1
+                continue
+            
+            if response.status_code == 200:
+                return response.json()
+            
+            # Expired or revoked token: refresh it once and retry straight away
+            if response.status_code == 401 and not refreshed:
+                token = self.tokens.refresh(token)
+                refreshed = True
+                continue
+            
+            if response.status_code in RETRY_STATUS_CODES and attempt < FETCH_MAX_RETRIES:
+                delay_s = retry_after_s(response, attempt)
+                if response.status_code == 429:
+                    self._pause(delay_s)
+                else:
+                    time.sleep(delay_s)
+                attempt += 1
+                continue
+            
+            raise AisFetchError(
+                f"Error fetching data: {response.status_code} - {response.text}", response.status_code
+            )
+    
+    def iter_fleet(self, mmsi_list, start, end, store=None):
+        """
+        Fetches every vessel's track between start and end, split into
+        sub-ranges of at most max_span that are requested in parallel.
+        Yields (mmsi, track DataFrame or None, error message or None) in
+        the order vessels complete.
+        
+        With an AisTrackStore only the part of the window after each
+        vessel's stored coverage is fetched; the new positions are merged
+        into the store and the track is read back from it.
+        """
+        mmsi_list = list(dict.fromkeys(mmsi_list))
+        windows = {
+            mmsi: split_window(store.fetch_start(mmsi, start) if store is not None else start, end, self.max_span)
+            for mmsi in mmsi_list
+        }
+        records = {mmsi: [] for mmsi in mmsi_list}
+        remaining = {mmsi: len(windows[mmsi]) for mmsi in mmsi_list}
+        errors = {}
+        
+        def vessel_track(mmsi):
+            if store is None:
+                return tracks_to_frame(records.pop(mmsi))
+            if windows[mmsi]:
+                store.add(mmsi, records.pop(mmsi), windows[mmsi][0][0], end)
+            return store.read(mmsi, start, end)
+        
+        # Vessels whose stored track already covers the window
+        for mmsi in mmsi_list:
+            if remaining[mmsi] == 0:
+                yield mmsi, vessel_track(mmsi), None
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.fetch_window, mmsi, window_start, window_end): mmsi
+                for mmsi in mmsi_list
+                for window_start, window_end in windows[mmsi]
+            }
+            
+            for future in as_completed(futures):
+                mmsi = futures[future]
+                try:
+                    records[mmsi].extend(future.result())
+                except AisFetchError as e:
+                    errors.setdefault(mmsi, str(e))
+                
+                remaining[mmsi] -= 1
+                if remaining[mmsi] == 0:
+                    if mmsi in errors:
+                        records.pop(mmsi)
+                        yield mmsi, None, errors[mmsi]
+                    else:
+                        yield mmsi, vessel_track(mmsi), None
+
+def last_days_window(days=7, now=None):
+    """
+    Returns the (start, end) UTC window covering the last days, to the second.
+    """
+    end = (now or datetime.now(timezone.utc)).replace(microsecond=0)
+    return end - timedelta(days=days), end
+
+# Shannon Index above which an OSA hex counts as high biodiversity (see
+# osa_core.categorize_shannon)
+HIGH_BIODIVERSITY_SHANNON = 4.0
+
+def trajectory_segments(tracks):
+    """
+    Turns the positions of any number of vessels (mmsi, msgtime, latitude,
+    longitude) into segments in one array pass: positions are sorted by
+    vessel and time, and each gets the H3 cell it lies in plus the
+    great-circle distance and time to the vessel's next position (zero for
+    its last one). Positions without a valid time or location are dropped.
+    """
+    epoch = pd.to_datetime(tracks['msgtime'], utc=True, errors='coerce')
+    valid = (epoch.notna() & tracks['latitude'].notna() & tracks['longitude'].notna()).to_numpy()
+    
+    segments = pd.DataFrame({
+        'mmsi': tracks['mmsi'].to_numpy()[valid],
+        'epoch': epoch[valid].astype('int64').to_numpy() / 1e9,
+        'latitude': tracks['latitude'].to_numpy(dtype=np.float64)[valid],
+        'longitude': tracks['longitude'].to_numpy(dtype=np.float64)[valid],
+    })
+    segments = segments.sort_values(['mmsi', 'epoch'], kind='stable').drop_duplicates(['mmsi', 'epoch'])
+    segments = segments.reset_index(drop=True)
+    
+    mmsi = segments['mmsi'].to_numpy()
+    lat, lon, t = (segments[col].to_numpy() for col in ('latitude', 'longitude', 'epoch'))
+    
+    # A segment runs from each position to the next one of the same vessel
+    has_next = np.zeros(len(segments), dtype=bool)
+    has_next[:-1] = mmsi[1:] == mmsi[:-1]
+    distance_km = np.zeros(len(segments))
+    duration_s = np.zeros(len(segments))
+    distance_km[:-1] = haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    duration_s[:-1] = t[1:] - t[:-1]
+    
+    segments['h3_index'] = latlng_to_cells(lat, lon)
+    segments['distance_km'] = np.where(has_next, distance_km, 0.0)
+    segments['duration_s'] = np.where(has_next, duration_s, 0.0)
+    return segments
+
+def osa_hex_shannon(cells, fetch_missing=True, on_warning=None):
+    """
+    Returns the highest Shannon Index of every OSA hex among cells, as a
+    Series indexed by uint64 cell. Hexes are served from the local OSA hex
+    cache; with fetch_missing the others are queried and cached too.
+    """
+    hex6_array = cells_to_str(np.unique(np.asarray(cells, dtype=np.uint64))).tolist()
+    cache = get_hex_cache()
+    
+    if fetch_missing:
+        rows, *_ = fetch_hex_rows(hex6_array, cache=cache, on_warning=on_warning)
+    else:
+        rows, _ = cache.lookup(OSA_DATASET_ID, hex6_array)
+    
+    if rows is None or rows.empty or 'shannon' not in rows.columns:
+        return pd.Series(dtype=np.float64)
+    return rows.groupby(str_to_cells(rows['hex6']))['shannon'].max()
+
+def trajectory_summary(segments, hex_shannon=None, high_shannon=HIGH_BIODIVERSITY_SHANNON):
+    """
+    Summarizes trajectory_segments per vessel: positions, time span, distance
+    travelled and average speed over the track. With hex_shannon (from
+    osa_hex_shannon) it also reports the time spent and distance travelled
+    inside high biodiversity hexes; each segment counts towards the hex it
+    starts in.
+    """
+    hours = segments['duration_s'] / 3600
+    columns = {
+        'positions': segments['mmsi'],
+        'first_seen': segments['epoch'],
+        'last_seen': segments['epoch'],
+        'distance_km': segments['distance_km'],
+        'duration_h': hours,
+    }
+    aggregations = {
+        'positions': 'size', 'first_seen': 'min', 'last_seen': 'max', 'distance_km': 'sum', 'duration_h': 'sum'
+    }
+    
+    if hex_shannon is not None:
+        shannon = segments['h3_index'].map(hex_shannon)
+        high = (shannon > high_shannon).to_numpy()
+        columns.update(
+            osa_hexes=segments['h3_index'].where(shannon.notna()),
+            high_biodiversity_h=hours.where(high, 0.0),
+            high_biodiversity_km=segments['distance_km'].where(high, 0.0),
+        )
+        aggregations.update(osa_hexes='nunique', high_biodiversity_h='sum', high_biodiversity_km='sum')
+    
+    summary = pd.DataFrame(columns).groupby(segments['mmsi'].to_numpy()).agg(aggregations)
+    summary.index.name = 'mmsi'
+    
+    summary['avg_speed_kn'] = summary['distance_km'] / 1.852 / summary['duration_h'].where(summary['duration_h'] > 0)
+    for col in ('first_seen', 'last_seen'):
+        summary[col] = pd.to_datetime(summary[col], unit='s', utc=True)
+    return summary
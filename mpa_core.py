@@ -0,0 +1,332 @@
+"""
+ProtectedSeas marine protected area (MPA) screening of asset registers,
+independent of Streamlit.
+
+The MPA polygons intersecting the assets' extent are fetched with one
+bounding box query (two where the extent crosses the antimeridian), parsed in bulk with shapely 2 array operations and kept
+in a local on-disk layer cache, so later runs over the same area do not
+touch the network. Assets are then tagged with every protected area within
+their screening radius in one STRtree spatial join.
+"""
+import functools
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from osa_core import EARTH_RADIUS_KM, PipelineMetrics
+
+logger = logging.getLogger(__name__)
+
+# ProtectedSeas Navigator dataset (table_v2)
+PROTECTED_SEAS_DATASET_ID = "3e32fd06-4eb7-4da2-9acb-dd0ecb58aa88"
+
+# Attributes kept for each protected area, when present in the dataset
+MPA_COLUMNS = [
+    'site_id', 'site_name', 'country', 'designation', 'category_name', 'iucn_cat',
+    'purpose', 'restrictions', 'managing_authority', 'wdpa_id',
+]
+
+# Local cache of parsed MPA layers, one Parquet file per query box
+MPA_CACHE_DIR = os.environ.get(
+    "MPA_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "osa", "protected_seas")
+)
+MPA_CACHE_TTL_S = 30 * 24 * 3600
+
+# Spatial filters tried in order when fetching a layer. `intersect` returns
+# every area overlapping the query box; `within` (as in the ProtectedSeas
+# notebooks) drops areas extending past it, so a layer fetched with it is
+# marked incomplete and never written to the disk cache
+MPA_SPATIAL_PREDICATES = ("intersect", "within")
+
+KM_PER_DEGREE = math.radians(1) * EARTH_RADIUS_KM
+
+class MpaLayer(NamedTuple):
+    """
+    A parsed MPA layer: the attribute table, the matching array of 2D
+    shapely geometries and an STRtree over them. complete is False when the
+    layer may lack areas extending past its query box.
+    """
+    areas: pd.DataFrame
+    geometries: np.ndarray
+    tree: shapely.STRtree
+    complete: bool = True
+
+def to_geometry_array(values):
+    """
+    Converts a column of WKT strings, WKB bytes or geometry objects to an
+    array of valid 2D shapely geometries in one pass. Unparseable entries
+    become None.
+    """
+    values = np.asarray(values, dtype=object)
+    sample = next((v for v in values if v is not None), None)
+
+    if isinstance(sample, str):
+        geometries = shapely.from_wkt(values, on_invalid='ignore')
+    elif isinstance(sample, (bytes, bytearray)):
+        geometries = shapely.from_wkb(values, on_invalid='ignore')
+    else:
+        geometries = values
+
+    geometries = shapely.force_2d(geometries)
+    invalid = ~shapely.is_valid(geometries) & ~shapely.is_missing(geometries)
+    if invalid.any():
+        geometries[invalid] = shapely.make_valid(geometries[invalid])
+    return geometries
+
+def build_mpa_layer(areas, geometries, complete=True):
+    """
+    Drops areas without a geometry and indexes the rest in an STRtree.
+    """
+    keep = ~shapely.is_missing(geometries) & ~shapely.is_empty(geometries)
+    areas = areas.loc[keep].reset_index(drop=True)
+    geometries = geometries[keep]
+    return MpaLayer(areas, geometries, shapely.STRtree(geometries), complete)
+
+def assets_query_boxes(lat, lon, radius_km):
+    """
+    Returns the (lon_min, lat_min, lon_max, lat_max) boxes covering every
+    asset plus its radius, snapped outward to whole degrees so nearby asset
+    sets share a cached layer. Where the radius reaches across the
+    antimeridian, the part beyond it is wrapped into a second box on the
+    other side.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    lat_pad = radius_km / KM_PER_DEGREE
+    lat_min = max(-90.0, math.floor(lat.min() - lat_pad))
+    lat_max = min(90.0, math.ceil(lat.max() + lat_pad))
+    # Degrees of longitude shrink towards the poles
+    widest = np.cos(np.radians(min(89.0, max(abs(lat_min), abs(lat_max)))))
+    lon_pad = radius_km / (KM_PER_DEGREE * widest)
+    lon_min = math.floor(lon.min() - lon_pad)
+    lon_max = math.ceil(lon.max() + lon_pad)
+
+    if lon_max - lon_min >= 360:
+        return ((-180.0, lat_min, 180.0, lat_max),)
+    boxes = [(max(-180.0, lon_min), lat_min, min(180.0, lon_max), lat_max)]
+    if lon_min < -180:
+        boxes.append((lon_min + 360.0, lat_min, 180.0, lat_max))
+    if lon_max > 180:
+        boxes.append((-180.0, lat_min, lon_max - 360.0, lat_max))
+    return tuple(boxes)
+
+@functools.lru_cache(maxsize=None)
+def get_protected_seas_table():
+    """
+    Connects to the ODP client once per process and returns the
+    ProtectedSeas table handle.
+    """
+    # Imported here so loading the module does not pull in the ODP SDK
+    from odp.client import OdpClient
+
+    client = OdpClient()
+    dataset = client.catalog.get((PROTECTED_SEAS_DATASET_ID))
+    return client.table_v2(dataset)
+
+def fetch_mpa_layer(box, on_warning=None):
+    """
+    Fetches the protected areas overlapping the query box, trying the
+    MPA_SPATIAL_PREDICATES in order. Returns the attribute table, the parsed
+    geometry array and whether the layer is complete (fetched with the
+    first predicate).
+    """
+    on_warning = on_warning or logger.warning
+    query_geometry = shapely.box(*box).wkt
+    table = get_protected_seas_table()
+
+    for i, predicate in enumerate(MPA_SPATIAL_PREDICATES):
+        try:
+            frames = list(table.select(f"geometry {predicate} '{query_geometry}'").dataframes())
+        except Exception as e:
+            if i == len(MPA_SPATIAL_PREDICATES) - 1:
+                raise
+            on_warning(f"Protected area query with '{predicate}' failed ({e}); falling back to "
+                       f"'{MPA_SPATIAL_PREDICATES[i + 1]}', which misses areas extending past the assets' extent")
+            continue
+        complete = i == 0
+        break
+
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=MPA_COLUMNS), np.empty(0, dtype=object), complete
+
+    df = pd.concat(frames, ignore_index=True)
+    areas = df[[col for col in MPA_COLUMNS if col in df.columns]]
+    return areas, to_geometry_array(df['geometry'].to_numpy()), complete
+
+def mpa_cache_path(box, cache_dir=MPA_CACHE_DIR):
+    # Keyed on the spatial filter too, as only complete layers are cached
+    key = hashlib.sha1(f"{PROTECTED_SEAS_DATASET_ID}:{MPA_SPATIAL_PREDICATES[0]}:{box}".encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"mpa_{key}.parquet")
+
+def load_mpa_layer(box, use_cache=True, cache_dir=MPA_CACHE_DIR, ttl_s=MPA_CACHE_TTL_S,
+                   on_warning=None, metrics=None):
+    """
+    Returns the MpaLayer for a query box, from the on-disk cache when a
+    fresh copy exists. Geometries are cached as WKB, which parses back in
+    bulk far faster than WKT. Incomplete layers are not cached.
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    path = mpa_cache_path(box, cache_dir)
+
+    if use_cache and os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl_s:
+        with metrics.stage('mpa.cache'):
+            df = pd.read_parquet(path)
+            geometries = shapely.from_wkb(df.pop('geometry_wkb').to_numpy())
+            complete = True
+    else:
+        with metrics.stage('mpa.remote'):
+            df, geometries, complete = fetch_mpa_layer(box, on_warning)
+        if use_cache and complete:
+            os.makedirs(cache_dir, exist_ok=True)
+            df.assign(geometry_wkb=shapely.to_wkb(geometries)).to_parquet(path, index=False)
+
+    with metrics.stage('mpa.index'):
+        return build_mpa_layer(df, geometries, complete)
+
+def clear_mpa_cache(cache_dir=MPA_CACHE_DIR):
+    """
+    Removes every cached MPA layer, in memory and on disk.
+    """
+    with _layers_lock:
+        _layers.clear()
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.startswith("mpa_") and name.endswith(".parquet"):
+                os.remove(os.path.join(cache_dir, name))
+
+def local_distances_km(geometries, lat, lon):
+    """
+    Distance in km from each point to the matching geometry, measured in a
+    local equirectangular projection centred on the point (accurate to well
+    under 1% at screening radii). Zero when the point lies inside.
+    """
+    coords, index = shapely.get_coordinates(geometries, return_index=True)
+    lat0, lon0 = lat[index], lon[index]
+    # Wrap longitude differences so areas across the antimeridian stay close
+    dlon = (coords[:, 0] - lon0 + 180.0) % 360.0 - 180.0
+    coords[:, 0] = dlon * np.cos(np.radians(lat0)) * KM_PER_DEGREE
+    coords[:, 1] = (coords[:, 1] - lat0) * KM_PER_DEGREE
+    projected = shapely.set_coordinates(np.array(geometries, dtype=object), coords)
+    return shapely.distance(shapely.points(np.zeros((len(lat), 2))), projected)
+
+def tag_assets_with_mpas(df, radius_km, layer, metrics=None):
+    """
+    Tags every asset with the protected areas within radius_km, in one bulk
+    STRtree join: each asset's radius box is matched against the indexed
+    polygons, then candidates are kept by their true distance. Returns one
+    row per (asset, protected area) with the distance in km and whether the
+    asset lies inside the area, nearest areas first.
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    columns = ['asset_id', *layer.areas.columns, 'distance_km', 'inside']
+
+    with metrics.stage('mpa.join'):
+        lat = df['lat'].to_numpy(dtype=np.float64)
+        lon = df['lon'].to_numpy(dtype=np.float64)
+        lat_pad = radius_km / KM_PER_DEGREE
+        lon_pad = lat_pad / np.maximum(np.cos(np.radians(lat)), 0.01)
+        # Boxes crossing the antimeridian are also queried shifted by 360 degrees
+        box_asset = np.arange(len(df))
+        box_lon = lon
+        for shift, crosses in ((360.0, lon - lon_pad < -180), (-360.0, lon + lon_pad > 180)):
+            box_asset = np.concatenate([box_asset, np.flatnonzero(crosses)])
+            box_lon = np.concatenate([box_lon, lon[crosses] + shift])
+        box_lat, box_pad = lat[box_asset], lon_pad[box_asset]
+        boxes = shapely.box(box_lon - box_pad, box_lat - lat_pad, box_lon + box_pad, box_lat + lat_pad)
+
+        box_idx, area_idx = layer.tree.query(boxes, predicate='intersects')
+        pairs = np.unique(np.column_stack([box_asset[box_idx], area_idx]), axis=0)
+        asset_idx, area_idx = pairs[:, 0], pairs[:, 1]
+        if len(asset_idx) == 0:
+            return pd.DataFrame(columns=columns)
+
+        distances = local_distances_km(layer.geometries[area_idx], lat[asset_idx], lon[asset_idx])
+        keep = distances <= radius_km
+        asset_idx, area_idx, distances = asset_idx[keep], area_idx[keep], distances[keep]
+
+        tagged = layer.areas.iloc[area_idx].reset_index(drop=True)
+        tagged.insert(0, 'asset_id', df['asset_id'].to_numpy()[asset_idx])
+        tagged['distance_km'] = distances.round(2)
+        tagged['inside'] = distances == 0
+        return tagged.sort_values(['asset_id', 'distance_km'], kind='stable', ignore_index=True)[columns]
+
+def summarize_asset_mpas(df, tagged):
+    """
+    Returns one row per asset with the number of protected areas within the
+    radius, how many contain the asset, the nearest distance and the area
+    names.
+    """
+    name_col = 'site_name' if 'site_name' in tagged.columns else None
+    grouped = tagged.groupby('asset_id', sort=False)
+    summary = pd.DataFrame({
+        'protected_areas': grouped.size(),
+        'inside': grouped['inside'].sum(),
+        'nearest_km': grouped['distance_km'].min(),
+    })
+    if name_col:
+        names = tagged[['asset_id', name_col]].dropna().drop_duplicates().astype({name_col: str})
+        summary['names'] = names.groupby('asset_id', sort=False)[name_col].agg("; ".join)
+
+    summary = summary.reindex(df['asset_id'].unique())
+    summary[['protected_areas', 'inside']] = summary[['protected_areas', 'inside']].fillna(0).astype(int)
+    summary.index.name = 'asset_id'
+    return summary
+
+def combine_mpa_layers(layers):
+    """
+    Merges the layers of several query boxes into one, keeping each area
+    once when it was returned for more than one box.
+    """
+    if len(layers) == 1:
+        return layers[0]
+
+    areas = pd.concat([layer.areas for layer in layers], ignore_index=True)
+    geometries = np.concatenate([layer.geometries for layer in layers])
+    keys = areas.assign(geometry_wkb=shapely.to_wkb(geometries))
+    keep = ~keys.duplicated().to_numpy()
+    return build_mpa_layer(
+        areas.loc[keep].reset_index(drop=True), geometries[keep], all(layer.complete for layer in layers)
+    )
+
+def screen_assets_for_mpas(df, radius_km, use_cache=True, on_warning=None, metrics=None):
+    """
+    Loads the MPA layer covering the assets and tags them. Returns (tagged
+    rows, per-asset summary, whether the layer is complete).
+    """
+    boxes = assets_query_boxes(df['lat'], df['lon'], radius_km)
+    layer = combine_mpa_layers([get_mpa_layer(box, use_cache, on_warning, metrics) for box in boxes])
+    tagged = tag_assets_with_mpas(df, radius_km, layer, metrics)
+    return tagged, summarize_asset_mpas(df, tagged), layer.complete
+
+# Parsed layers kept in memory by query box, with the time they were loaded
+_layers = {}
+_layers_lock = threading.Lock()
+
+def get_mpa_layer(box, use_cache=True, on_warning=None, metrics=None, ttl_s=MPA_CACHE_TTL_S):
+    """
+    Returns the MpaLayer for a query box. With use_cache, complete layers
+    are kept in memory for the process so Streamlit reruns reuse the parsed
+    geometries and STRtree until they are ttl_s old; without it the layer
+    is always fetched remotely.
+    """
+    if use_cache:
+        with _layers_lock:
+            loaded_at, layer = _layers.get(box, (None, None))
+        if layer is not None and time.time() - loaded_at < ttl_s:
+            return layer
+
+    layer = load_mpa_layer(box, use_cache, ttl_s=ttl_s, on_warning=on_warning, metrics=metrics)
+    if use_cache and layer.complete:
+        with _layers_lock:
+            _layers[box] = (time.time(), layer)
+    return layer
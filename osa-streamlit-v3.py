@@ -1,8 +1,27 @@
+import os
 import streamlit as st
 import pandas as pd
-import os
 import h3
-from odp.client import OdpClient
+import osa_core
+from osa_core import (
+    DEFAULT_QUERY_WORKERS,
+    EXPORT_FORMATS,
+    REPORT_COLUMNS,
+    PipelineMetrics,
+    asset_signatures,
+    build_asset_report_table,
+    cells_to_str,
+    export_results,
+    filter_results,
+    fingerprint_results,
+    format_asset_reports,
+    get_hex_cache,
+    get_osa_table,
+    query_osa_chunk,
+    update_asset_report_table,
+    update_osa_results,
+)
+from mpa_core import clear_mpa_cache, screen_assets_for_mpas
 
 # Set page configuration
 st.set_page_config(
@@ -21,238 +40,144 @@ to return results based on your own asset data.
 # Initialize session state variables if they don't exist
 if 'processed_df' not in st.session_state:
     st.session_state.processed_df = None
-if 'final_results_df' not in st.session_state:
-    st.session_state.final_results_df = None
+if 'processed_neighbors' not in st.session_state:
+    st.session_state.processed_neighbors = None
+if 'osa_results' not in st.session_state:
+    st.session_state.osa_results = None
 if 'distance_km' not in st.session_state:
     st.session_state.distance_km = 50
 if 'asset_reports' not in st.session_state:
     st.session_state.asset_reports = {}
+if 'results_fingerprint' not in st.session_state:
+    st.session_state.results_fingerprint = None
+if 'report_cache' not in st.session_state:
+    st.session_state.report_cache = None
+if 'cache_stats' not in st.session_state:
+    st.session_state.cache_stats = None
+if 'streamed_results' not in st.session_state:
+    st.session_state.streamed_results = None
+if 'load_metrics' not in st.session_state:
+    st.session_state.load_metrics = None
+if 'metrics' not in st.session_state:
+    st.session_state.metrics = None
+if 'mpa_results' not in st.session_state:
+    st.session_state.mpa_results = None
 
-# Biodiversity analysis functions
-def categorize_shannon(shannon):
-    if shannon is None:
-        return "N/A"
-    if shannon < 2.0:
-        return "Low Biodiversity"
-    elif 2.0 <= shannon <= 4.0:
-        return "Medium Biodiversity"
-    else:
-        return "High Biodiversity"
-
-def categorize_simpson(simpson):
-    if simpson is None:
-        return "N/A"
-    if simpson > 0.5:
-        return "High Dominance, Low Evenness"
-    elif 0.2 <= simpson <= 0.5:
-        return "Moderate Dominance"
-    else:
-        return "Low Dominance, High Evenness"
-
-def generate_asset_report(df, radius_km):
-    report_dict = {}
-    
-    # Compute asset ranking based on average Shannon Index
-    asset_ranks = df.groupby("asset_id")["shannon"].mean().rank(ascending=False).to_dict()
-    
-    # Sort assets by biodiversity rank (higher Shannon Index first)
-    sorted_assets = df.groupby("asset_id")["shannon"].mean().sort_values(ascending=False).index
+def get_asset_reports(results, fingerprint, radius_km, metrics=None):
+    """
+    Returns the per-asset reports, the ranked selection options and the
+    combined TXT export, regenerating them only when the query results or
+    the radius change. Widget interactions in the Analysis tab reuse the
+    copy held in session state, and after an incremental rerun only the
+    report rows of new or changed assets are recomputed.
+    """
+    key = (fingerprint, radius_km)
+    cache = st.session_state.report_cache
     
-    for asset_id in sorted_assets:
-        asset_df = df[df['asset_id'] == asset_id]
-        
-        # Extract exact location row
-        exact_location = asset_df[asset_df['is_neighbor'].str.lower() == "asset"]
-        if not exact_location.empty:
-            exact_shannon = exact_location['shannon'].values[0]
-            exact_simpson = exact_location['simpson'].values[0]
-            ecosystems = [eco.capitalize() for eco in ['mangrove', 'seamount', 'cold_water_coral', 'seagrass', 'coral'] 
-                          if eco in exact_location.columns and exact_location[eco].values[0] > 0]
+    if cache is None or cache['key'] != key:
+        metrics = metrics if metrics is not None else PipelineMetrics()
+        with metrics.stage('report.generate'):
+            signatures = asset_signatures(results)
+            if cache is not None and cache['key'][0] == fingerprint:
+                # Only the radius in the report text changed
+                table = cache['table']
+            elif cache is not None:
+                table = update_asset_report_table(cache['table'], cache['signatures'], results, signatures)
+            else:
+                # Only join the columns the reports actually read
+                df = results.wide(columns=REPORT_COLUMNS, neighbor_labels=False)
+                table = build_asset_report_table(df)
+            reports = format_asset_reports(table, radius_km)
             
-            # Extract name if it exists
-            asset_name = exact_location['name'].values[0] if 'name' in exact_location.columns else None
-        else:
-            exact_shannon, exact_simpson, ecosystems, asset_name = None, None, [], None
+            # Sort by rank (lower rank number = higher biodiversity)
+            sorted_assets = sorted(
+                reports.items(),
+                key=lambda x: (x[1]["rank"] if x[1]["rank"] is not None else float('inf'))
+            )
             
-        # Extract surrounding data
-        neighbors = asset_df[asset_df['is_neighbor'].str.lower() == "neighbor"]
-        avg_shannon = neighbors['shannon'].mean() if not neighbors.empty else None
-        avg_simpson = neighbors['simpson'].mean() if not neighbors.empty else None
-        
-        # Rank and total assets
-        asset_rank = asset_ranks.get(asset_id, None)
-        total_assets = df['asset_id'].nunique()
-        
-        # Helper function to format with default value
-        def safe_format(value):
-            return f"{value:.3f}" if value is not None else "N/A"
-        
-        # Construct Report
-        report = f"""
-Asset ID: {asset_id}"""
-
-        # Add name if it exists
-        if asset_name is not None:
-            report += f"\nName: {asset_name}"
+            # Create selection options with rank and name (if available)
+            ranked_options = {}
+            for asset_id, info in sorted_assets:
+                option_text = f"#{int(info['rank']) if info['rank'] else 'N/A'} - Asset ID: {asset_id}"
+                if info['name'] is not None:
+                    option_text += f" ({info['name']})"
+                ranked_options[option_text] = asset_id
             
-        report += f"""
-Biodiversity Rank: #{int(asset_rank) if asset_rank else "N/A"} out of {total_assets}
------------------------------------
-Immediate Vicinity:
-  - Shannon Index: {safe_format(exact_shannon)} ({categorize_shannon(exact_shannon)})
-  - Simpson Index: {safe_format(exact_simpson)} ({categorize_simpson(exact_simpson)})
-  - Ecosystems: {', '.join(ecosystems) if ecosystems else "None"}
-Surrounding Area ({radius_km}km radius):
-  - Avg Shannon Index: {safe_format(avg_shannon)} ({categorize_shannon(avg_shannon)})
-  - Avg Simpson Index: {safe_format(avg_simpson)} ({categorize_simpson(avg_simpson)})
-"""
-        # Add ecosystem coverage if available
-        if not neighbors.empty:
-            report += "  - % Coverage:\n"
-            for eco in ['coral', 'seagrass', 'cold_water_coral', 'mangrove', 'seamount']:
-                if eco in neighbors.columns:
-                    report += f"    - {eco.replace('_', ' ').title()}: {safe_format(neighbors[eco].mean() * 100)}%\n"
-        
-        report_dict[asset_id] = {
-            "report": report, 
-            "rank": asset_rank,
-            "name": asset_name  # Store the name for use in display
-        }
+            all_reports = "\n\n" + "-"*80 + "\n\n".join(
+                [info["report"] for info in reports.values()]
+            )
+            
+            cache = {
+                'key': key,
+                'table': table,
+                'signatures': signatures,
+                'reports': reports,
+                'ranked_options': ranked_options,
+                'all_reports': all_reports
+            }
+        st.session_state.report_cache = cache
     
-    return report_dict
+    return cache['reports'], cache['ranked_options'], cache['all_reports']
 
 # Function to load and process asset data
-def load_and_process_asset_data(uploaded_file, distance_km=50):
+def load_and_process_asset_data(uploaded_file, distance_km=50, metrics=None):
     """
-    Loads asset data from an uploaded file, verifies required columns (case insensitive),
-    and adds an H3 index (resolution 6) column based on latitude and longitude.
-    Also computes surrounding H3 indexes within a specified distance.
+    Runs osa_core.load_and_process_asset_data on the uploaded file, showing
+    problems in the app. Returns (None, None) if the file cannot be used.
     """
     try:
-        # Determine file type and read the data with encoding handling
-        if uploaded_file.name.endswith('.csv'):
-            df = pd.read_csv(uploaded_file, encoding="utf-8")
-        elif uploaded_file.name.endswith(('.xls', '.xlsx')):
-            df = pd.read_excel(uploaded_file)
-        else:
-            st.error("Unsupported file format. Use CSV or Excel (.xls/.xlsx).")
-            return None
-    except UnicodeDecodeError:
-        df = pd.read_csv(uploaded_file, encoding="ISO-8859-1")
-        
-    # Normalize column names (convert to lowercase for easy matching)
-    df.columns = df.columns.str.lower()
+        return osa_core.load_and_process_asset_data(
+            uploaded_file, distance_km, on_warning=st.warning, metrics=metrics
+        )
+    except ValueError as e:
+        st.error(str(e))
+        return None, None
+
+# Function to query Ocean Sensitive Areas Dataset
+def query_osa_data(df, neighbors, max_workers=DEFAULT_QUERY_WORKERS, use_cache=True, compact=False,
+                   previous=None, metrics=None):
+    """
+    Queries the OSA dataset for the processed assets. With the previous
+    run's results, only hexes that run did not cover are queried.
+    """
+    cache = get_hex_cache() if use_cache else None
+    progress_bar = st.progress(0)
+    if previous is not None:
+        results, reused, hits, misses = update_osa_results(
+            previous, df, neighbors, max_workers, cache, compact, progress_bar.progress, st.warning, metrics
+        )
+        st.info(f"Reused {reused} hexes from the previous run")
+    else:
+        results, hits, misses = query_osa_chunk(
+            df, neighbors, max_workers, cache, compact, progress_bar.progress, st.warning, metrics
+        )
     
-    # Define possible column name variations
-    lat_columns = {'latitude', 'lat'}
-    lon_columns = {'longitude', 'long', 'lon'}
-    asset_id_columns = {'asset_id', 'id', 'assetid'}
-    name_columns = {'name', 'asset_name', 'title', 'label'}
+    st.session_state.cache_stats = {'hits': hits, 'misses': misses}
+    st.info(f"Cache: {hits} hexes served locally, {misses} fetched remotely")
     
-    # Find actual column names in the dataset
-    lat_col = next((col for col in df.columns if col in lat_columns), None)
-    lon_col = next((col for col in df.columns if col in lon_columns), None)
-    asset_id_col = next((col for col in df.columns if col in asset_id_columns), None)
-    name_col = next((col for col in df.columns if col in name_columns), None)
+    if misses:
+        display_name, _ = get_osa_table()
+        st.success(f"Connected to dataset: {display_name}")
     
-    # Validate presence of required columns
-    if not lat_col or not lon_col:
-        st.error("Error: The file must contain 'latitude' and 'longitude' (or 'lat' and 'long') columns.")
+    if results is None:
+        st.error("No results found for any assets.")
         return None
     
-    if not asset_id_col:
-        st.warning("No asset ID column found. Adding a sequential ID column.")
-        df['asset_id'] = range(1, len(df) + 1)
-        asset_id_col = 'asset_id'
-    
-    # Compute H3 index at resolution 6
-    df['h3_index'] = df.apply(lambda row: h3.latlng_to_cell(row[lat_col], row[lon_col], 6), axis=1)
-    
-    # Compute surrounding H3 hexagons within the given distance
-    def get_h3_neighbors(h3_index):
-        num_rings = round(distance_km / 8.74)  # Approximate conversion for resolution 6
-        return list(h3.grid_disk(h3_index, num_rings))
-    
-    df['h3_neighbors'] = df['h3_index'].apply(get_h3_neighbors)
-    
-    # Create a standardized DataFrame with consistent column names
-    result_columns = {
-        'asset_id': df[asset_id_col],
-        'lat': df[lat_col],
-        'lon': df[lon_col],
-        'h3_index': df['h3_index'],
-        'h3_neighbors': df['h3_neighbors']
-    }
-    
-    # Add name column if it exists
-    if name_col:
-        result_columns['name'] = df[name_col]
-    
-    result_df = pd.DataFrame(result_columns)
-    
-    return result_df
+    return results
 
-# Function to query Ocean Sensitive Areas Dataset
-def query_osa_data(df):
-    with st.spinner("Connecting to HUB Ocean Ocean Sensitive Area Data..."):
-        # Connect to ODP client
-        client = OdpClient()
-        
-        # Request the dataset from the catalog using the UUID
-        osa_table_dataset = client.catalog.get(("468bef0c-5934-44e6-bd3e-5a60a0b326b6"))
-        osa_data = client.table_v2(osa_table_dataset)
-        
-        st.success(f"Connected to dataset: {osa_table_dataset.metadata.display_name}")
-    
-    # Initialize an empty list to store the results for all assets
-    all_results = []
-    
+def stream_results_to_csv(uploaded_file, distance_km, max_workers=DEFAULT_QUERY_WORKERS, use_cache=True,
+                          compact=False, metrics=None):
+    """
+    Runs osa_core.stream_results_to_csv with progress and warnings shown in
+    the app. Returns the file path and the number of rows written.
+    """
     progress_bar = st.progress(0)
-    total_assets = len(df)
-    
-    # Loop through each asset in the DataFrame
-    for i, (_, row) in enumerate(df.iterrows()):
-        # Update progress
-        progress_bar.progress((i + 1) / total_assets)
-        
-        # Get the asset's H3 index and neighbors
-        hex6_set = {row['h3_index']}  # Add the asset's H3 index
-        hex6_set.update(row['h3_neighbors'])  # Add its neighbors
-        
-        # Convert the set to a list for query construction
-        hex6_array = list(hex6_set)
-        
-        # Build the query using OR conditions
-        query = " OR ".join(f'hex6 == "{h}"' for h in hex6_array)
-        
-        try:
-            # Execute the query to get results for the current asset and its neighbors
-            result_df = next(osa_data.select(query).dataframes())
-            
-            # Add a column to indicate whether the record is a neighbor or the main asset
-            result_df['is_neighbor'] = result_df['hex6'].apply(
-                lambda x: 'Neighbor' if x != row['h3_index'] and x in row['h3_neighbors'] else 'Asset'
-            )
-            
-            # Add the asset_id to the results
-            result_df['asset_id'] = row['asset_id']
-            
-            # Add asset name if it exists
-            if 'name' in row:
-                result_df['name'] = row['name']
-            
-            # Append the result to the all_results list
-            all_results.append(result_df)
-        except Exception as e:
-            st.warning(f"Error querying for asset {row['asset_id']}: {e}")
+    path, total_rows, hits, misses = osa_core.stream_results_to_csv(
+        uploaded_file, distance_km, max_workers, use_cache, compact, progress_bar.progress, st.warning, metrics
+    )
     
-    # Concatenate all the individual results into a single DataFrame
-    if all_results:
-        final_results_df = pd.concat(all_results, ignore_index=True)
-        return final_results_df
-    else:
-        st.error("No results found for any assets.")
-        return None
+    st.session_state.cache_stats = {'hits': hits, 'misses': misses}
+    return path, total_rows
 
 # Create sidebar for file upload and parameters
 with st.sidebar:
@@ -260,8 +185,8 @@ with st.sidebar:
     
     # File uploader
     uploaded_file = st.file_uploader(
-        "Upload your asset data (CSV or Excel)- see info box for expected values",
-        type=["csv", "xlsx", "xls"],
+        "Upload your asset data (CSV, Parquet or Excel)- see info box for expected values",
+        type=["csv", "parquet", "xlsx", "xls"],
         help="File should contain columns for asset_id, latitude/lat, longitude/long/lon, and optionally name"
     )
     
@@ -275,6 +200,55 @@ with st.sidebar:
         help="Radius in kilometers around each asset to include in the query"
     )
     
+    # Number of concurrent remote queries
+    query_workers = st.slider(
+        "Parallel queries",
+        min_value=1,
+        max_value=16,
+        value=DEFAULT_QUERY_WORKERS,
+        help="Number of Ocean Sensitive Area queries to run concurrently"
+    )
+    
+    # Query coarser parent cells as hex6 ranges for wide-area screening
+    compact_queries = st.checkbox(
+        "Compact hex queries",
+        value=False,
+        help="Merge complete groups of neighboring hexes into parent cells and query them as hex6 ranges"
+    )
+    
+    # Local cache of previously fetched OSA hexes
+    use_cache = st.checkbox(
+        "Use local OSA cache",
+        value=True,
+        help="Reuse Ocean Sensitive Area rows and protected area layers fetched by previous runs"
+    )
+    
+    # Rerun only what changed since the last Run Analytics
+    incremental = st.checkbox(
+        "Reuse previous results",
+        value=True,
+        help="After changing the assets or radius, only query newly covered hexes and update the reports of changed assets"
+    )
+    
+    # Tag assets with the ProtectedSeas marine protected areas within the radius
+    screen_mpas = st.checkbox(
+        "Screen marine protected areas",
+        value=False,
+        help="Tag each asset with the ProtectedSeas protected areas within the radius when running analytics"
+    )
+    
+    if st.button("Clear OSA cache"):
+        get_hex_cache().clear()
+        clear_mpa_cache()
+        st.success("OSA cache and protected area layers cleared")
+    
+    # Exact peak memory per run for the Diagnostics tab, at a cost in speed
+    trace_memory = st.checkbox(
+        "Trace memory allocations",
+        value=False,
+        help="Record the peak memory allocated by each run (slows processing down)"
+    )
+    
     # Store distance_km in session state for analysis tab
     st.session_state.distance_km = distance_km
     
@@ -283,9 +257,14 @@ with st.sidebar:
     
     if process_button and uploaded_file is not None:
         with st.spinner("Processing asset data..."):
-            processed_df = load_and_process_asset_data(uploaded_file, distance_km)
+            load_metrics = PipelineMetrics(trace_memory)
+            processed_df, neighbors = load_and_process_asset_data(uploaded_file, distance_km, load_metrics)
+            load_metrics.finish()
             if processed_df is not None:
                 st.session_state.processed_df = processed_df
+                st.session_state.processed_neighbors = neighbors
+                st.session_state.load_metrics = load_metrics
+                st.session_state.metrics = load_metrics
                 st.success(f"Processed {len(processed_df)} assets successfully")
     
     # Query button (only enabled if data is processed)
@@ -295,48 +274,137 @@ with st.sidebar:
     )
     
     if query_button and st.session_state.processed_df is not None:
+        previous = st.session_state.osa_results if incremental else None
+        
+        # A run's diagnostics cover loading the current assets plus this query
+        metrics = PipelineMetrics(trace_memory)
+        if st.session_state.load_metrics is not None:
+            metrics.merge(st.session_state.load_metrics)
+        st.session_state.metrics = metrics
+        
         with st.spinner("Querying Ocean Sensitive Areas..."):
-            final_results_df = query_osa_data(st.session_state.processed_df)
-            if final_results_df is not None:
-                st.session_state.final_results_df = final_results_df
-                st.success(f"Found {len(final_results_df)} records")
+            osa_results = query_osa_data(
+                st.session_state.processed_df,
+                st.session_state.processed_neighbors,
+                query_workers,
+                use_cache,
+                compact_queries,
+                previous,
+                metrics
+            )
+            if osa_results is not None:
+                st.session_state.osa_results = osa_results
+                st.session_state.results_fingerprint = fingerprint_results(osa_results)
+                if previous is None:
+                    # Rows may have been refetched, so rebuild every report
+                    st.session_state.report_cache = None
+                st.success(f"Found {osa_results.record_count()} records")
+        
+        if screen_mpas:
+            with st.spinner("Screening marine protected areas..."):
+                try:
+                    st.session_state.mpa_results = screen_assets_for_mpas(
+                        st.session_state.processed_df, distance_km, use_cache, st.warning, metrics
+                    )
+                    st.success(f"Found {len(st.session_state.mpa_results[0])} asset/protected area matches")
+                except Exception as e:
+                    st.session_state.mpa_results = None
+                    st.warning(f"Marine protected area screening unavailable: {e}")
+    
+    # Streaming mode: read, index and query large files chunk by chunk
+    stream_button = st.button(
+        "Stream Large File to CSV",
+        disabled=uploaded_file is None,
+        help="Process and query the file in chunks without loading it into the app"
+    )
+    
+    if stream_button and uploaded_file is not None:
+        with st.spinner("Streaming assets through the Ocean Sensitive Areas query..."):
+            # Only the latest streamed file is kept on disk
+            if st.session_state.streamed_results is not None:
+                try:
+                    os.remove(st.session_state.streamed_results[0])
+                except OSError:
+                    pass
+                st.session_state.streamed_results = None
+            try:
+                st.session_state.metrics = PipelineMetrics(trace_memory)
+                st.session_state.streamed_results = stream_results_to_csv(
+                    uploaded_file, distance_km, query_workers, use_cache, compact_queries,
+                    st.session_state.metrics
+                )
+                st.success(f"Wrote {st.session_state.streamed_results[1]} records")
+            except ValueError as e:
+                st.error(str(e))
+    
+    if st.session_state.streamed_results is not None:
+        # Deferred, so the file is only read when the download is clicked
+        streamed_path = st.session_state.streamed_results[0]
+        st.download_button(
+            label="Download Streamed Results as CSV",
+            data=lambda: open(streamed_path, "rb"),
+            file_name="osa_results.csv",
+            mime="text/csv"
+        )
 
-# Main content - added Analysis tab
-tabs = st.tabs(["Asset Data", "Query Results", "Analysis"])
+# Main content - added Analysis, Protected Areas and Diagnostics tabs
+tabs = st.tabs(["Asset Data", "Query Results", "Analysis", "Protected Areas", "Diagnostics"])
 
 # Asset Data Tab
 with tabs[0]:
     if st.session_state.processed_df is not None:
         st.subheader("Processed Asset Data")
-        st.dataframe(st.session_state.processed_df.drop(columns=['h3_neighbors']))
+        processed_df = st.session_state.processed_df
+        st.dataframe(processed_df.assign(h3_index=cells_to_str(processed_df['h3_index'])))
         
         # Display some sample H3 neighbors
-        if len(st.session_state.processed_df) > 0:
+        if len(processed_df) > 0:
             st.subheader("Sample H3 Neighbors")
-            sample_asset = st.session_state.processed_df.iloc[0]
-            st.write(f"Asset ID: {sample_asset['asset_id']}")
-            if 'name' in sample_asset:
-                st.write(f"Name: {sample_asset['name']}")
-            st.write(f"H3 Index: {sample_asset['h3_index']}")
-            st.write(f"Number of neighboring hexagons: {len(sample_asset['h3_neighbors'])}")
+            # Read scalars per column: a row of mixed dtypes would upcast the
+            # uint64 H3 index and the asset ID to float64
+            sample_neighbors = st.session_state.processed_neighbors.row(0)
+            st.write(f"Asset ID: {processed_df['asset_id'].iloc[0]}")
+            if 'name' in processed_df.columns:
+                st.write(f"Name: {processed_df['name'].iloc[0]}")
+            st.write(f"H3 Index: {h3.int_to_str(int(processed_df['h3_index'].iloc[0]))}")
+            st.write(f"Number of neighboring hexagons: {len(sample_neighbors)}")
             st.write("Sample neighbors (first 5):")
-            st.write(", ".join(sample_asset['h3_neighbors'][:5]))
+            st.write(", ".join(cells_to_str(sample_neighbors[:5])))
     else:
         st.info("Upload your asset data file and click 'Process Asset Data' to get started.")
 
 # Query Results Tab
 with tabs[1]:
-    if st.session_state.final_results_df is not None:
+    if st.session_state.osa_results is not None:
         st.subheader("Query Results")
-        st.dataframe(st.session_state.final_results_df)
+        results = st.session_state.osa_results
+        
+        # Filter and paginate on the compact links; only the visible page is expanded
+        filter_cols = st.columns(3)
+        with filter_cols[0]:
+            view = st.selectbox("Show", ["All", "Asset rows", "Neighbor rows"])
+        with filter_cols[1]:
+            asset_filter = st.text_input("Filter by asset ID")
+        with filter_cols[2]:
+            page_size = st.selectbox("Rows per page", [100, 500, 1000, 5000], index=1)
+        
+        filtered = filter_results(results, view, asset_filter.strip())
+        total_pages = max(1, -(-len(filtered.links) // page_size))
+        page = st.number_input("Page", min_value=1, max_value=total_pages, value=1, step=1)
+        
+        start = (page - 1) * page_size
+        page_results = filtered._replace(links=filtered.links.iloc[start:start + page_size])
+        st.dataframe(page_results.wide())
+        st.caption(f"Page {page} of {total_pages} ({len(filtered.links)} matching asset/hex links)")
         
-        # Download button for results
-        csv = st.session_state.final_results_df.to_csv(index=False)
+        # Download button for results; the export is only built when clicked
+        export_format = st.radio("Export format", list(EXPORT_FORMATS), horizontal=True)
+        file_name, mime = EXPORT_FORMATS[export_format]
         st.download_button(
-            label="Download Results as CSV",
-            data=csv,
-            file_name="osa_results.csv",
-            mime="text/csv"
+            label=f"Download Results as {export_format}",
+            data=lambda: export_results(results, export_format),
+            file_name=file_name,
+            mime=mime
         )
         
         # Show basic summary statistics
@@ -344,29 +412,43 @@ with tabs[1]:
         
         # Asset counts
         st.write(f"Total number of assets: {st.session_state.processed_df['asset_id'].nunique()}")
-        st.write(f"Total records in results: {len(st.session_state.final_results_df)}")
+        st.write(f"Total records in results: {results.record_count()}")
+        st.write(f"Unique hexes in results: {st.session_state.osa_results.hex_rows['hex_id'].nunique()}")
+        
+        # Cache effectiveness for the last run
+        if st.session_state.cache_stats is not None:
+            st.write(
+                f"Cache hits: {st.session_state.cache_stats['hits']} hexes, "
+                f"cache misses: {st.session_state.cache_stats['misses']} hexes"
+            )
     else:
         st.info("Process your asset data and query the Ocean Sensitive Areas dataset to see results here.")
 
 # Analysis Tab (New)
 with tabs[2]:
-    if st.session_state.final_results_df is not None:
+    if st.session_state.osa_results is not None:
         st.subheader("Biodiversity Analysis")
         
         # Generate biodiversity reports
         with st.spinner("Generating biodiversity reports..."):
-            df = st.session_state.final_results_df
+            results = st.session_state.osa_results
             
             # Check if required columns exist
             required_cols = ['shannon', 'simpson']
-            missing_cols = [col for col in required_cols if col not in df.columns]
+            missing_cols = [col for col in required_cols if col not in results.hex_rows.columns]
             
             if missing_cols:
                 st.error(f"Missing required columns in dataset: {', '.join(missing_cols)}")
                 st.info("The analysis requires Shannon and Simpson indices to be present in the dataset.")
             else:
-                # Generate reports and store in session state
-                st.session_state.asset_reports = generate_asset_report(df, st.session_state.distance_km)
+                # Reuse the reports unless the results or the radius changed
+                asset_reports, ranked_options, all_reports = get_asset_reports(
+                    results,
+                    st.session_state.results_fingerprint,
+                    st.session_state.distance_km,
+                    st.session_state.metrics
+                )
+                st.session_state.asset_reports = asset_reports
                 
                 # Create two display options
                 display_option = st.radio(
@@ -376,45 +458,31 @@ with tabs[2]:
                 )
                 
                 if display_option == "Ranked by Biodiversity":
-                    # Sort by rank (lower rank number = higher biodiversity)
-                    sorted_assets = sorted(
-                        st.session_state.asset_reports.items(),
-                        key=lambda x: (x[1]["rank"] if x[1]["rank"] is not None else float('inf'))
-                    )
-                    
-                    # Create selection options with rank and name (if available)
-                    options = []
-                    for asset_id, info in sorted_assets:
-                        option_text = f"#{int(info['rank'])} - Asset ID: {asset_id}"
-                        if info['name'] is not None:
-                            option_text += f" ({info['name']})"
-                        options.append(option_text)
-                    
                     # Display the dropdown with ranking information
-                    if options:
+                    if ranked_options:
                         selected_option = st.selectbox(
                             "Select Asset by Biodiversity Rank", 
-                            options=options
+                            options=list(ranked_options)
                         )
                         
-                        # Extract asset_id from the selected option
-                        selected_asset_id = int(selected_option.split("Asset ID: ")[1].split(" ")[0])
+                        # Look up the asset_id behind the selected option
+                        selected_asset_id = ranked_options[selected_option]
                         
                         # Display the report
                         st.text_area(
                             "Biodiversity Report", 
-                            st.session_state.asset_reports[selected_asset_id]["report"], 
+                            asset_reports[selected_asset_id]["report"], 
                             height=400
                         )
                 
                 else:  # "Select by Asset ID"
                     # Get all asset IDs and sort them numerically
-                    asset_ids = sorted(st.session_state.asset_reports.keys())
+                    asset_ids = sorted(asset_reports.keys())
                     
                     if asset_ids:
                         # Create a format function to include name if available
                         def format_asset_option(asset_id):
-                            asset_info = st.session_state.asset_reports[asset_id]
+                            asset_info = asset_reports[asset_id]
                             if asset_info['name'] is not None:
                                 return f"Asset ID: {asset_id} ({asset_info['name']})"
                             else:
@@ -429,14 +497,11 @@ with tabs[2]:
                         # Display the report for the selected asset
                         st.text_area(
                             "Biodiversity Report", 
-                            st.session_state.asset_reports[selected_asset]["report"], 
+                            asset_reports[selected_asset]["report"], 
                             height=400
                         )
                 
                 # Option to download all reports
-                all_reports = "\n\n" + "-"*80 + "\n\n".join(
-                    [info["report"] for info in st.session_state.asset_reports.values()]
-                )
                 st.download_button(
                     label="Download All Reports as TXT",
                     data=all_reports,
@@ -444,4 +509,92 @@ with tabs[2]:
                     mime="text/plain"
                 )
     else:
-        st.info("Process your asset data and query the Ocean Sensitive Areas dataset to generate biodiversity analysis.")
\ No newline at end of file
+        st.info("Process your asset data and query the Ocean Sensitive Areas dataset to generate biodiversity analysis.")
+
+# Protected Areas Tab
+with tabs[3]:
+    if st.session_state.mpa_results is not None:
+        st.subheader("Marine Protected Areas")
+        tagged, mpa_summary, complete = st.session_state.mpa_results
+        
+        if not complete:
+            st.warning(
+                "The protected area layer could only be fetched with a 'within' filter, which leaves out "
+                "areas extending past the assets' extent. Assets without matches may still lie in or "
+                "near a large protected area; treat this screen as incomplete."
+            )
+        
+        flagged = mpa_summary[mpa_summary['protected_areas'] > 0]
+        st.write(
+            f"{len(flagged)} of {len(mpa_summary)} assets have protected areas within the radius, "
+            f"{int((mpa_summary['inside'] > 0).sum())} lie inside one"
+        )
+        
+        only_flagged = st.checkbox("Only assets near protected areas", value=True)
+        st.dataframe(flagged if only_flagged else mpa_summary)
+        
+        st.subheader("Asset / Protected Area Matches")
+        st.dataframe(tagged)
+        st.download_button(
+            label="Download Protected Area Matches as CSV",
+            data=tagged.to_csv(index=False),
+            file_name="asset_protected_areas.csv",
+            mime="text/csv"
+        )
+    else:
+        st.info("Enable 'Screen marine protected areas' and run analytics to tag assets with nearby protected areas.")
+
+# Diagnostics Tab
+with tabs[4]:
+    if st.session_state.metrics is not None:
+        st.subheader("Pipeline Diagnostics")
+        summary = st.session_state.metrics.summary()
+        
+        st.write(f"Run wall time: {summary['wall_seconds']:.2f}s")
+        
+        # Wall time per stage, in pipeline order
+        if summary['stages']:
+            stage_df = pd.DataFrame.from_dict(summary['stages'], orient='index')
+            stage_df['share_pct'] = 100 * stage_df['seconds'] / max(summary['total_seconds'], 1e-9)
+            st.dataframe(stage_df.round({'seconds': 3, 'share_pct': 1}))
+        
+        # Remote query latency, rows and bytes
+        queries = summary['queries']
+        st.write(
+            f"Remote queries: {queries['count']} ({queries['failed']} failed, {queries['retries']} retries)"
+        )
+        if queries['latency_s'] is not None:
+            latency = queries['latency_s']
+            st.write(
+                f"Latency p50 {latency['p50']:.3f}s, p90 {latency['p90']:.3f}s, "
+                f"p99 {latency['p99']:.3f}s, max {latency['max']:.3f}s"
+            )
+            st.write(
+                f"Rows per query: mean {queries['rows']['mean']:.0f}, max {queries['rows']['max']:.0f}; "
+                f"bytes per query: mean {queries['bytes']['mean'] / 1024:.1f} KB, "
+                f"total {queries['bytes']['total'] / (1024 * 1024):.1f} MB"
+            )
+        
+        # Peak memory
+        if summary['run_peak_rss_mb'] is not None:
+            st.write(
+                f"Process memory during this run: up to {summary['run_peak_rss_mb']:.1f} MB at stage ends "
+                f"(from {summary['start_rss_mb']:.1f} MB at the start)"
+            )
+        if summary['process_peak_rss_mb'] is not None:
+            st.write(f"Process memory high-water mark, across all runs: {summary['process_peak_rss_mb']:.1f} MB")
+        if summary['peak_traced_mb'] is not None:
+            st.write(f"Peak traced allocations: {summary['peak_traced_mb']:.1f} MB")
+        
+        st.download_button(
+            label="Download Diagnostics as JSON",
+            data=st.session_state.metrics.to_json(),
+            file_name="osa_diagnostics.json",
+            mime="application/json"
+        )
+    else:
+        st.info("Process your asset data to record pipeline diagnostics here.")
+
+# Stop tracing allocations once the run has rendered
+if st.session_state.metrics is not None:
+    st.session_state.metrics.finish()
@@ -0,0 +1,338 @@
+"""
+Offline benchmark of the Ocean Sensitive Areas screening pipeline.
+
+Replaces the HUB Ocean table with a local stand-in that serves a synthetic
+OSA table keyed by hex6, with configurable query latency, scales asset.csv
+up to larger synthetic asset registers and reports wall time, throughput
+and memory for every pipeline stage. Needs no credentials or network access.
+
+Example:
+    python osa_benchmark.py --sizes 20,1000,10000,100000 --latency-ms 150 --output bench.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+import osa_core
+from osa_core import (
+    DEFAULT_QUERY_WORKERS,
+    ECOSYSTEM_COLUMNS,
+    OSA_DATASET_ID,
+    REPORT_COLUMNS,
+    OsaHexCache,
+    PipelineMetrics,
+    cells_to_str,
+    export_results,
+    generate_asset_report,
+    iter_asset_chunks,
+    load_and_process_asset_data,
+    query_osa_chunk,
+    resolve_asset_columns,
+)
+
+logger = logging.getLogger("osa_benchmark")
+
+# Default register sizes, scaled up from the 20 assets in asset.csv. A
+# 100,000 asset register at a 50 km radius needs around 8 GB of memory,
+# so pass it explicitly with --sizes.
+DEFAULT_SIZES = [20, 1_000, 10_000]
+
+def synthetic_osa_table(hex6_values, coverage=0.7, seed=0):
+    """
+    Builds a synthetic OSA table with one row for a random share (coverage)
+    of the given hexes, holding the columns the reports read.
+    """
+    rng = np.random.default_rng(seed)
+    hex6_values = np.unique(np.asarray(hex6_values, dtype=str))
+    hex6_values = hex6_values[rng.random(len(hex6_values)) < coverage]
+    n = len(hex6_values)
+    
+    table = pd.DataFrame({
+        'hex6': hex6_values,
+        'shannon': rng.gamma(4.0, 0.75, n),
+        'simpson': rng.beta(2.0, 5.0, n),
+    })
+    
+    # Most hexes contain none of a given ecosystem
+    for eco in ECOSYSTEM_COLUMNS:
+        table[eco] = np.where(rng.random(n) < 0.15, rng.random(n), 0.0)
+    
+    return table
+
+class FakeCursor:
+    """
+    Result of a FakeOsaTable query. The injected latency is spent when the
+    batches are consumed, as with the real cursor.
+    """
+    def __init__(self, rows, delay_s, batch_rows):
+        self.rows = rows
+        self.delay_s = delay_s
+        self.batch_rows = batch_rows
+    
+    def dataframes(self):
+        time.sleep(self.delay_s)
+        for start in range(0, len(self.rows), self.batch_rows):
+            yield self.rows.iloc[start:start + self.batch_rows].reset_index(drop=True)
+
+class FakeOsaTable:
+    """
+    Local stand-in for OdpClient().table_v2(...). Answers the hex6 filters
+    built by osa_core.build_hex_query (equality, IN lists and hex6 ranges)
+    from an in-memory table. Each query waits latency_s plus
+    latency_per_row_s per returned row, scaled by a random factor within
+    +/- jitter, and fails with probability failure_rate.
+    """
+    HEX6_EQUALS = re.compile(r'hex6 == "([0-9a-f]+)"')
+    HEX6_IN = re.compile(r'hex6 in \(([^)]*)\)')
+    HEX6_RANGE = re.compile(r'hex6 >= "([0-9a-f]+)" AND hex6 <= "([0-9a-f]+)"')
+    
+    def __init__(self, table, latency_s=0.0, latency_per_row_s=0.0, jitter=0.0, failure_rate=0.0,
+                 batch_rows=10_000, seed=0):
+        self.table = table.sort_values('hex6').reset_index(drop=True)
+        self.hex6 = self.table['hex6'].to_numpy(dtype=str)
+        self.latency_s = latency_s
+        self.latency_per_row_s = latency_per_row_s
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.batch_rows = batch_rows
+        self.calls = 0
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+    
+    def match(self, filter_query):
+        """
+        Returns the sorted table positions matching a hex6 filter.
+        """
+        values = self.HEX6_EQUALS.findall(filter_query)
+        for in_list in self.HEX6_IN.findall(filter_query):
+            values.extend(re.findall(r'"([0-9a-f]+)"', in_list))
+        
+        values = np.asarray(values, dtype=str)
+        found = np.searchsorted(self.hex6, values).clip(max=max(len(self.hex6) - 1, 0))
+        positions = [found[self.hex6[found] == values]] if len(self.hex6) else []
+        
+        for lowest, highest in self.HEX6_RANGE.findall(filter_query):
+            start = np.searchsorted(self.hex6, lowest, side='left')
+            stop = np.searchsorted(self.hex6, highest, side='right')
+            positions.append(np.arange(start, stop))
+        
+        return np.unique(np.concatenate(positions)) if positions else np.empty(0, dtype=np.int64)
+    
+    def select(self, filter_query, **kwargs):
+        rows = self.table.iloc[self.match(filter_query)]
+        
+        with self._lock:
+            self.calls += 1
+            scale = 1.0 + self.jitter * (2.0 * self._rng.random() - 1.0)
+            failed = self._rng.random() < self.failure_rate
+        
+        delay_s = max(0.0, (self.latency_s + self.latency_per_row_s * len(rows)) * scale)
+        if failed:
+            time.sleep(delay_s)
+            raise ConnectionError("Injected query failure")
+        
+        return FakeCursor(rows, delay_s, self.batch_rows)
+
+class FakeOdpClient:
+    """
+    Stand-in for odp.client.OdpClient whose catalog only knows the OSA
+    dataset and whose table_v2 returns the given FakeOsaTable.
+    """
+    def __init__(self, table):
+        self.table = table
+        self.catalog = SimpleNamespace(get=self.get_dataset)
+    
+    def get_dataset(self, dataset_id):
+        return SimpleNamespace(id=dataset_id, metadata=SimpleNamespace(display_name="Synthetic Ocean Sensitive Areas"))
+    
+    def table_v2(self, dataset):
+        return self.table
+
+@contextlib.contextmanager
+def fake_odp(client):
+    """
+    Routes the pipeline's OSA queries to a FakeOdpClient while active.
+    """
+    def get_osa_table():
+        dataset = client.catalog.get(OSA_DATASET_ID)
+        return dataset.metadata.display_name, client.table_v2(dataset)
+    
+    original = osa_core.get_osa_table
+    osa_core.get_osa_table = get_osa_table
+    try:
+        yield client
+    finally:
+        osa_core.get_osa_table = original
+
+def synthetic_asset_register(template_path, n_assets, spread_deg=1.0, seed=0):
+    """
+    Scales the template asset register up to n_assets. The template assets
+    are kept as they are and the rest are scattered within spread_deg
+    degrees of randomly chosen template locations.
+    """
+    base = pd.read_csv(template_path)
+    lat_col, lon_col, _, _ = resolve_asset_columns(base.columns)
+    base_lat, base_lon = base[lat_col].to_numpy(), base[lon_col].to_numpy()
+    
+    rng = np.random.default_rng(seed)
+    extra = max(0, n_assets - len(base))
+    origin = rng.integers(0, len(base), extra)
+    
+    lat = np.concatenate((base_lat, base_lat[origin] + rng.uniform(-spread_deg, spread_deg, extra)))[:n_assets]
+    lon = np.concatenate((base_lon, base_lon[origin] + rng.uniform(-spread_deg, spread_deg, extra)))[:n_assets]
+    
+    return pd.DataFrame({
+        'asset_id': np.arange(1, n_assets + 1),
+        'name': [f"Synthetic asset {i}" for i in range(1, n_assets + 1)],
+        'lat': np.clip(lat, -89.9, 89.9),
+        'lon': (lon + 180.0) % 360.0 - 180.0,
+    })
+
+def covered_hexes(asset_path, radius_km):
+    """
+    Returns every hex6 value the assets in the file cover at this radius,
+    used to size the synthetic OSA table.
+    """
+    with open(asset_path, "rb") as asset_file:
+        cells = [
+            np.concatenate((df['h3_index'].to_numpy(dtype=np.uint64), neighbors.cells))
+            for df, neighbors in iter_asset_chunks(asset_file, radius_km)
+        ]
+    return cells_to_str(np.unique(np.concatenate(cells)))
+
+def run_benchmark(n_assets, args, work_dir):
+    """
+    Runs load, query, report and export for one synthetic register and
+    returns the PipelineMetrics summary with size and throughput figures.
+    """
+    asset_path = os.path.join(work_dir, f"assets_{n_assets}.csv")
+    synthetic_asset_register(args.template, n_assets, args.spread_deg, args.seed).to_csv(asset_path, index=False)
+    
+    table = FakeOsaTable(
+        synthetic_osa_table(covered_hexes(asset_path, args.radius), args.coverage, args.seed),
+        latency_s=args.latency_ms / 1000,
+        latency_per_row_s=args.latency_per_row_us / 1e6,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    )
+    cache = OsaHexCache(os.path.join(work_dir, f"cache_{n_assets}.sqlite")) if args.cache else None
+    metrics = PipelineMetrics(args.trace_memory)
+    
+    with fake_odp(FakeOdpClient(table)):
+        df, neighbors = load_and_process_asset_data(asset_path, args.radius, metrics=metrics)
+        results, hits, misses = query_osa_chunk(
+            df, neighbors, args.workers, cache, args.compact, metrics=metrics
+        )
+        
+        if results is not None:
+            with metrics.stage('report.wide'):
+                report_df = results.wide(columns=REPORT_COLUMNS, neighbor_labels=False)
+            generate_asset_report(report_df, args.radius, metrics)
+            
+            with metrics.stage('export.results'):
+                export_results(results, args.export_format).close()
+    
+    metrics.finish()
+    summary = metrics.summary()
+    
+    summary['assets'] = n_assets
+    summary['unique_hexes'] = int(len(np.unique(neighbors.cells)))
+    summary['osa_table_rows'] = len(table.table)
+    summary['remote_calls'] = table.calls
+    summary['cache_hits'], summary['cache_misses'] = hits, misses
+    summary['links'] = 0 if results is None else len(results.links)
+    summary['records'] = 0 if results is None else results.record_count()
+    for entry in summary['stages'].values():
+        entry['assets_per_s'] = n_assets / entry['seconds'] if entry['seconds'] > 0 else None
+    
+    return summary
+
+def format_summary(summary):
+    """
+    Renders one benchmark summary as a text table.
+    """
+    lines = [
+        f"{summary['assets']} assets: {summary['unique_hexes']} hexes, {summary['links']} links, "
+        f"{summary['records']} records, {summary['remote_calls']} remote calls, "
+        f"{summary['wall_seconds']:.2f}s wall",
+        f"  {'stage':<16}{'seconds':>10}{'calls':>7}{'assets/s':>14}{'RSS MB':>13}",
+    ]
+    for name, entry in summary['stages'].items():
+        rate = f"{entry['assets_per_s']:,.0f}" if entry['assets_per_s'] else "-"
+        peak = f"{entry['rss_mb']:.0f}" if entry['rss_mb'] is not None else "-"
+        lines.append(f"  {name:<16}{entry['seconds']:>10.3f}{entry['calls']:>7}{rate:>14}{peak:>13}")
+    
+    latency = summary['queries']['latency_s']
+    if latency is not None:
+        lines.append(
+            f"  query latency p50 {latency['p50'] * 1000:.0f} ms, p99 {latency['p99'] * 1000:.0f} ms; "
+            f"{summary['queries']['bytes']['total'] / (1024 * 1024):.1f} MB returned"
+        )
+    if summary['run_peak_rss_mb'] is not None:
+        lines.append(
+            f"  resident memory {summary['start_rss_mb']:.0f} MB at start, "
+            f"up to {summary['run_peak_rss_mb']:.0f} MB at stage ends"
+        )
+    if summary['peak_traced_mb'] is not None:
+        lines.append(f"  peak traced allocations {summary['peak_traced_mb']:.0f} MB")
+    
+    return "\n".join(lines)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the OSA screening pipeline offline against a synthetic OSA table."
+    )
+    parser.add_argument("--sizes", default=",".join(str(n) for n in DEFAULT_SIZES),
+                        help="Comma-separated asset register sizes")
+    parser.add_argument("--template", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "asset.csv"),
+                        help="Asset register to scale up (default: asset.csv)")
+    parser.add_argument("--spread-deg", type=float, default=1.0,
+                        help="Scatter of synthetic assets around the template locations, in degrees")
+    parser.add_argument("--radius", type=float, default=50, help="Radius in km around each asset (default: 50)")
+    parser.add_argument("--coverage", type=float, default=0.7, help="Share of hexes with an OSA row")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Injected latency per query")
+    parser.add_argument("--latency-per-row-us", type=float, default=0.0, help="Injected latency per returned row")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Relative random variation of the latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of queries that fail and are retried")
+    parser.add_argument("--workers", type=int, default=DEFAULT_QUERY_WORKERS, help="Concurrent queries")
+    parser.add_argument("--compact", action="store_true", help="Query compacted parent cells as hex6 ranges")
+    parser.add_argument("--cache", action="store_true", help="Use a fresh local OSA hex cache for each size")
+    parser.add_argument("--export-format", choices=list(osa_core.EXPORT_FORMATS), default="Parquet",
+                        help="Format used for the export stage")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Trace Python allocations for an exact peak memory figure (slower)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic data")
+    parser.add_argument("--output", metavar="PATH", help="Write all summaries as JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    
+    summaries = []
+    with tempfile.TemporaryDirectory(prefix="osa_benchmark_") as work_dir:
+        for n_assets in sizes:
+            summary = run_benchmark(n_assets, args, work_dir)
+            print(format_summary(summary), flush=True)
+            summaries.append(summary)
+    
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            json.dump({'settings': vars(args), 'runs': summaries}, out, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""
+Headless batch screening of an asset register against the HUB Ocean Ocean
+Sensitive Area dataset, without Streamlit.
+
+Example:
+    python osa_cli.py asset.csv --radius 50 --output-dir osa_output --format parquet --processes 4
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from osa_core import (
+    ASSET_CHUNK_ROWS,
+    DEFAULT_QUERY_WORKERS,
+    EXPORT_FORMATS,
+    REPORT_COLUMNS,
+    PipelineMetrics,
+    build_asset_report_table,
+    concat_results,
+    export_results,
+    format_asset_reports,
+    get_hex_cache,
+    index_asset_frame,
+    iter_asset_frames,
+    query_osa_chunk,
+)
+
+logger = logging.getLogger("osa_cli")
+
+# Command line names for the export formats
+CLI_FORMATS = {"csv": "CSV", "csv.gz": "CSV (gzip)", "parquet": "Parquet"}
+
+# Chunks submitted per worker process before waiting on the oldest one
+CHUNKS_IN_FLIGHT_PER_PROCESS = 2
+
+def screen_chunk(df, radius, max_workers, use_cache, compact, metrics=None):
+    """
+    H3-indexes and queries one standardized chunk of assets. Runs in a worker
+    process, which opens its own ODP connection and cache handle and sends
+    its metrics back. Returns (OsaResults or None, cache hits, cache misses,
+    metrics).
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    df, neighbors = index_asset_frame(df, radius, metrics)
+    cache = get_hex_cache() if use_cache else None
+    return (*query_osa_chunk(df, neighbors, max_workers, cache, compact, metrics=metrics), metrics)
+
+def count_asset_rows(path):
+    """
+    Returns the number of data rows in an asset file: from the footer for
+    Parquet and by counting lines for CSV. Returns None for Excel, which
+    is loaded whole anyway.
+    """
+    lowered = path.lower()
+    if lowered.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        
+        return pq.ParquetFile(path).metadata.num_rows
+    if lowered.endswith('.csv'):
+        lines, last = 0, b"\n"
+        with open(path, "rb") as asset_file:
+            for block in iter(lambda: asset_file.read(1 << 20), b""):
+                lines += block.count(b"\n")
+                last = block[-1:]
+        # A last line without a trailing newline still counts
+        return max(lines + (last != b"\n") - 1, 0)
+    return None
+
+def chunk_rows_for(args):
+    """
+    Sizes the asset chunks so every worker process gets at least one:
+    registers smaller than processes * --chunk-rows are split evenly.
+    """
+    if args.processes <= 1:
+        return args.chunk_rows
+    n_rows = count_asset_rows(args.asset_file)
+    if not n_rows:
+        return args.chunk_rows
+    return max(1, min(args.chunk_rows, -(-n_rows // args.processes)))
+
+def iter_screened_chunks(asset_frames, args, metrics):
+    """
+    Yields screen_chunk outputs for each asset frame in file order. With
+    --processes > 1 the frames are indexed and queried in worker processes,
+    and at most CHUNKS_IN_FLIGHT_PER_PROCESS chunks per process are pending
+    at once so the parent never reads far ahead of the workers.
+    """
+    task_args = (args.radius, args.workers, not args.no_cache, args.compact)
+    
+    if args.processes <= 1:
+        for df in asset_frames:
+            yield screen_chunk(df, *task_args, metrics)
+        return
+    
+    max_pending = args.processes * CHUNKS_IN_FLIGHT_PER_PROCESS
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        pending = deque()
+        for df in asset_frames:
+            pending.append(pool.submit(screen_chunk, df, *task_args))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def run_screening(args, metrics):
+    """
+    Reads the asset file in chunks and screens them, in parallel worker
+    processes when requested. Only each chunk's compact results are kept.
+    Returns the combined OsaResults (or None) and the total cache hits and
+    misses.
+    """
+    chunk_results = []
+    hits = misses = 0
+    
+    with open(args.asset_file, "rb") as asset_file:
+        asset_frames = iter_asset_frames(asset_file, chunk_rows_for(args), metrics=metrics)
+        for i, (results, chunk_hits, chunk_misses, chunk_metrics) in enumerate(
+                iter_screened_chunks(asset_frames, args, metrics), start=1):
+            hits += chunk_hits
+            misses += chunk_misses
+            if chunk_metrics is not metrics:
+                metrics.merge(chunk_metrics, worker=True)
+            if results is not None:
+                chunk_results.append(results)
+            logger.info("Screened asset chunk %d", i)
+    
+    with metrics.stage('query.concat'):
+        results = concat_results(chunk_results)
+    
+    return results, hits, misses
+
+def write_outputs(results, args, metrics):
+    """
+    Writes the wide results, the per-asset report table and the text
+    reports to the output directory.
+    """
+    os.makedirs(args.output_dir, exist_ok=True)
+    
+    export_format = CLI_FORMATS[args.format]
+    results_path = os.path.join(args.output_dir, EXPORT_FORMATS[export_format][0])
+    with metrics.stage('export.results'), export_results(results, export_format) as export, \
+            open(results_path, "wb") as out:
+        shutil.copyfileobj(export, out)
+    logger.info("Wrote %d result records to %s", results.record_count(), results_path)
+    
+    if not {'shannon', 'simpson'} <= set(results.hex_rows.columns):
+        logger.warning("Shannon and Simpson indices missing from the dataset; skipping reports.")
+        return
+    
+    with metrics.stage('report.table'):
+        df = results.wide(columns=REPORT_COLUMNS, neighbor_labels=False)
+        table = build_asset_report_table(df)
+        table_path = os.path.join(args.output_dir, "asset_report_table.csv")
+        table.to_csv(table_path)
+    
+    with metrics.stage('report.generate'):
+        reports = format_asset_reports(table, args.radius)
+    reports_path = os.path.join(args.output_dir, "biodiversity_reports.txt")
+    with open(reports_path, "w", encoding="utf-8") as out:
+        out.write("\n\n" + "-"*80 + "\n\n".join(info["report"] for info in reports.values()))
+    logger.info("Wrote %d asset reports to %s", len(reports), reports_path)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Screen an asset register against the HUB Ocean Ocean Sensitive Area dataset."
+    )
+    parser.add_argument("asset_file", help="Asset file (CSV, Parquet or Excel) with lat/lon and optional asset_id/name")
+    parser.add_argument("--radius", type=float, default=50, help="Radius in km around each asset (default: 50)")
+    parser.add_argument("--output-dir", default="osa_output", help="Directory for results and reports")
+    parser.add_argument("--format", choices=list(CLI_FORMATS), default="parquet", help="Results file format")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes, one asset chunk each")
+    parser.add_argument("--workers", type=int, default=DEFAULT_QUERY_WORKERS,
+                        help="Concurrent remote queries per process")
+    parser.add_argument("--chunk-rows", type=int, default=ASSET_CHUNK_ROWS,
+                        help="Maximum assets per chunk; smaller registers are split evenly across --processes")
+    parser.add_argument("--compact", action="store_true", help="Query compacted parent cells as hex6 ranges")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the local OSA hex cache")
+    parser.add_argument("--metrics", metavar="PATH", help="Write stage timings, query latency and memory as JSON")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Trace Python allocations for an exact peak memory figure (slower)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    metrics = PipelineMetrics(args.trace_memory)
+    
+    try:
+        results, hits, misses = run_screening(args, metrics)
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
+    
+    logger.info("Cache: %d hexes served locally, %d fetched remotely", hits, misses)
+    
+    if results is None:
+        logger.error("No results found for any assets.")
+        return 1
+    
+    write_outputs(results, args, metrics)
+    
+    metrics.finish()
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as out:
+            out.write(metrics.to_json())
+        logger.info("Wrote pipeline metrics to %s", args.metrics)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1496 @@
+"""
+Core Ocean Sensitive Areas screening pipeline, independent of Streamlit.
+
+Loads asset registers, indexes them to H3 cells, queries the HUB Ocean Ocean
+Sensitive Area dataset and generates the per-asset biodiversity reports. Used
+by the Streamlit app (osa-streamlit-v3.py) and the batch CLI (osa_cli.py).
+"""
+import contextlib
+import functools
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import NamedTuple
+
+import h3
+import h3.api.numpy_int as h3_int
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Pipeline instrumentation
+
+def peak_rss_mb():
+    """
+    High-water mark of this process's resident memory in MB, or None where
+    the platform does not report it. It covers the whole process lifetime,
+    so in a long-running server it includes every earlier run.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def current_rss_mb():
+    """
+    Current resident memory of this process in MB, or None where it cannot
+    be read (/proc/self/statm is Linux only).
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+class PipelineMetrics:
+    """
+    Records where a run spends its time: wall time per pipeline stage and
+    for the whole run, the latency, rows and bytes of every remote query,
+    and memory. Stages are named "<phase>.<step>" (e.g. "load.parse",
+    "query.remote"). Thread safe, so query worker threads record into the
+    same instance. Stages merged from worker processes are kept apart in
+    worker_stages, summed over the workers, as they overlap in time.
+    
+    Memory for the run is the resident size sampled at the end of every
+    stage, against the size when the run started. With trace_memory=True
+    Python allocations are also traced for an exact per-run peak, at a
+    noticeable cost in speed. The process high-water mark is reported
+    separately, as it spans every earlier run in the same process.
+    """
+    def __init__(self, trace_memory=False):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.start_counter = time.perf_counter()
+        self.wall_seconds = None
+        self.merged_wall_seconds = 0.0
+        self.stages = {}
+        self.worker_stages = {}
+        self.queries = []
+        self.trace_memory = trace_memory
+        self.peak_traced_mb = None
+        self.start_rss_mb = current_rss_mb()
+        
+        if trace_memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+    
+    def __getstate__(self):
+        # Locks cannot be pickled; worker processes send their metrics back
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block and adds it to the named stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - start)
+    
+    def add_stage_time(self, name, seconds, calls=1):
+        """
+        Adds time (and calls) to the named stage and samples memory.
+        """
+        rss = current_rss_mb()
+        with self.lock:
+            entry = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'rss_mb': None})
+            entry['seconds'] += seconds
+            entry['calls'] += calls
+            if rss is not None:
+                entry['rss_mb'] = max(entry['rss_mb'] or 0.0, rss)
+            if self.trace_memory and tracemalloc.is_tracing():
+                self.peak_traced_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    
+    def timed(self, name, iterable):
+        """
+        Yields from iterable, adding the time spent producing each item to
+        the named stage. The final call that exhausts the iterable adds its
+        time but is not counted as a call.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            item = next(iterator, StopIteration)
+            if item is StopIteration:
+                self.add_stage_time(name, time.perf_counter() - start, calls=0)
+                return
+            self.add_stage_time(name, time.perf_counter() - start)
+            yield item
+    
+    def record_query(self, latency_s, rows, nbytes, attempts=1, failed=False):
+        """
+        Records one remote query: the latency of its last attempt, the rows
+        and in-memory bytes it returned and how many attempts it took.
+        """
+        with self.lock:
+            self.queries.append((latency_s, rows, nbytes, attempts, failed))
+    
+    def elapsed_seconds(self):
+        """
+        Wall time of the run: from creation until finish() (or now), plus
+        the wall time of runs merged in sequentially.
+        """
+        own = self.wall_seconds if self.wall_seconds is not None else time.perf_counter() - self.start_counter
+        return own + self.merged_wall_seconds
+    
+    def merge(self, other, worker=False):
+        """
+        Adds the stages and queries recorded by another PipelineMetrics.
+        A finished earlier step of the same run (worker=False) adds its
+        stages and wall time. A worker process (worker=True) ran alongside
+        this one, so its stages go to worker_stages and its wall time is
+        not added; stage times there are summed over the workers.
+        """
+        def add_stages(target, source):
+            for name, other_entry in source.items():
+                entry = target.setdefault(name, {'seconds': 0.0, 'calls': 0, 'rss_mb': None})
+                entry['seconds'] += other_entry['seconds']
+                entry['calls'] += other_entry['calls']
+                samples = [r for r in (entry['rss_mb'], other_entry['rss_mb']) if r is not None]
+                entry['rss_mb'] = max(samples) if samples else None
+        
+        with self.lock:
+            add_stages(self.worker_stages if worker else self.stages, other.stages)
+            add_stages(self.worker_stages, other.worker_stages)
+            if not worker:
+                self.merged_wall_seconds += other.elapsed_seconds()
+            self.queries.extend(other.queries)
+            if other.peak_traced_mb is not None:
+                self.peak_traced_mb = max(self.peak_traced_mb or 0.0, other.peak_traced_mb)
+    
+    def finish(self):
+        """
+        Stops the run's wall clock, and memory tracing if this instance
+        started it.
+        """
+        if self.wall_seconds is None:
+            self.wall_seconds = time.perf_counter() - self.start_counter
+        if self.trace_memory and tracemalloc.is_tracing():
+            self.peak_traced_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+    
+    def summary(self):
+        """
+        Returns the recorded metrics as a JSON-serializable dict.
+        """
+        with self.lock:
+            stages = {name: dict(entry) for name, entry in self.stages.items()}
+            worker_stages = {name: dict(entry) for name, entry in self.worker_stages.items()}
+            queries = list(self.queries)
+        
+        def describe(values, percentiles):
+            if len(values) == 0:
+                return None
+            values = np.asarray(values, dtype=np.float64)
+            stats = {f"p{p}": float(np.percentile(values, p)) for p in percentiles}
+            stats.update(total=float(values.sum()), mean=float(values.mean()), max=float(values.max()))
+            return stats
+        
+        rss_samples = [
+            entry['rss_mb'] for entry in (*stages.values(), *worker_stages.values()) if entry['rss_mb'] is not None
+        ]
+        completed = [q for q in queries if not q[4]]
+        latencies, rows, nbytes = ([q[i] for q in completed] for i in range(3))
+        
+        return {
+            'started_at': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            'stages': stages,
+            'wall_seconds': self.elapsed_seconds(),
+            'total_seconds': sum(entry['seconds'] for entry in stages.values()),
+            'worker_stages': worker_stages,
+            'worker_seconds': sum(entry['seconds'] for entry in worker_stages.values()),
+            'queries': {
+                'count': len(queries),
+                'failed': len(queries) - len(completed),
+                'retries': sum(q[3] - 1 for q in queries),
+                'latency_s': describe(latencies, (50, 90, 95, 99)),
+                'rows': describe(rows, (50, 90)),
+                'bytes': describe(nbytes, (50, 90)),
+            },
+            'start_rss_mb': self.start_rss_mb,
+            'run_peak_rss_mb': max(rss_samples) if rss_samples else None,
+            'process_peak_rss_mb': peak_rss_mb(),
+            'peak_traced_mb': self.peak_traced_mb,
+        }
+    
+    def to_json(self, indent=2):
+        return json.dumps(self.summary(), indent=indent)
+
+# Biodiversity analysis functions
+def categorize_shannon(shannon):
+    if shannon is None:
+        return "N/A"
+    if shannon < 2.0:
+        return "Low Biodiversity"
+    elif 2.0 <= shannon <= 4.0:
+        return "Medium Biodiversity"
+    else:
+        return "High Biodiversity"
+
+def categorize_simpson(simpson):
+    if simpson is None:
+        return "N/A"
+    if simpson > 0.5:
+        return "High Dominance, Low Evenness"
+    elif 0.2 <= simpson <= 0.5:
+        return "Moderate Dominance"
+    else:
+        return "Low Dominance, High Evenness"
+
+# OSA columns read by the biodiversity reports
+ECOSYSTEM_COLUMNS = ['mangrove', 'seamount', 'cold_water_coral', 'seagrass', 'coral']
+REPORT_COLUMNS = ['shannon', 'simpson', *ECOSYSTEM_COLUMNS]
+
+def build_asset_report_table(df):
+    """
+    Computes every per-asset report figure in one grouped pass: the average
+    Shannon Index and rank over all rows, the exact location's indices and
+    ecosystems, and the neighbor averages and ecosystem coverage.
+    Returns a DataFrame indexed by asset_id, sorted by biodiversity rank.
+    """
+    ecosystems = [eco for eco in ECOSYSTEM_COLUMNS if eco in df.columns]
+    # Aggregate in float64, as the results store the indices as float32
+    df = df.astype({col: np.float64 for col in ['shannon', 'simpson', *ecosystems]})
+    is_neighbor = df['is_neighbor']
+    if is_neighbor.dtype != bool:
+        # Wide views with 'Asset'/'Neighbor' labels, e.g. read back from an export
+        is_neighbor = is_neighbor.astype(str).str.lower() == 'neighbor'
+    is_neighbor = is_neighbor.to_numpy()
+    
+    # Rank assets by their average Shannon Index (higher first)
+    table = df.groupby('asset_id', sort=False)['shannon'].mean().to_frame('mean_shannon')
+    table['rank'] = table['mean_shannon'].rank(ascending=False)
+    
+    # Exact location: the first "Asset" row of every asset
+    exact_columns = ['shannon', 'simpson', *ecosystems]
+    if 'name' in df.columns:
+        exact_columns.append('name')
+    exact = df.loc[~is_neighbor, ['asset_id', *exact_columns]]
+    exact = exact.drop_duplicates('asset_id', keep='first').set_index('asset_id')
+    table['has_exact'] = table.index.isin(exact.index)
+    table = table.join(exact.add_prefix('exact_'))
+    
+    # Surrounding area: averages over the "Neighbor" rows of every asset
+    neighbor_groups = df[is_neighbor].groupby('asset_id')
+    table['neighbor_count'] = neighbor_groups.size()
+    table['neighbor_count'] = table['neighbor_count'].fillna(0).astype(int)
+    table = table.join(neighbor_groups[['shannon', 'simpson', *ecosystems]].mean().add_prefix('avg_'))
+    
+    # Inverse-distance weighted neighbor averages (closer hexes count more)
+    if 'hex_distance_km' in df.columns:
+        neighbors = df.loc[is_neighbor, ['asset_id', 'shannon', 'simpson', 'hex_distance_km']]
+        weights = 1.0 / np.maximum(neighbors['hex_distance_km'].to_numpy(dtype=np.float64), 1.0)
+        for col in ['shannon', 'simpson']:
+            valid = neighbors[col].notna().to_numpy()
+            weighted = pd.DataFrame({
+                'asset_id': neighbors['asset_id'].to_numpy()[valid],
+                'value': neighbors[col].to_numpy(dtype=np.float64)[valid] * weights[valid],
+                'weight': weights[valid]
+            }).groupby('asset_id')[['value', 'weight']].sum()
+            table[f'wavg_{col}'] = weighted['value'] / weighted['weight']
+    
+    return table.sort_values('mean_shannon', ascending=False, kind='stable')
+
+def format_asset_report(asset_id, row, total_assets, radius_km):
+    """
+    Renders the text report for one row (as a dict) of the asset report table.
+    """
+    # Helper function to format with default value
+    def safe_format(value):
+        return f"{value:.3f}" if value is not None else "N/A"
+    
+    ecosystems_present = [eco for eco in ECOSYSTEM_COLUMNS if f"exact_{eco}" in row]
+    
+    if row['has_exact']:
+        exact_shannon = row['exact_shannon']
+        exact_simpson = row['exact_simpson']
+        ecosystems = [eco.capitalize() for eco in ecosystems_present if row[f"exact_{eco}"] > 0]
+        asset_name = row['exact_name'] if 'exact_name' in row else None
+    else:
+        exact_shannon, exact_simpson, ecosystems, asset_name = None, None, [], None
+    
+    has_neighbors = row['neighbor_count'] > 0
+    avg_shannon = row['avg_shannon'] if has_neighbors else None
+    avg_simpson = row['avg_simpson'] if has_neighbors else None
+    wavg_shannon = row.get('wavg_shannon') if has_neighbors else None
+    wavg_simpson = row.get('wavg_simpson') if has_neighbors else None
+    
+    asset_rank = None if pd.isna(row['rank']) else row['rank']
+    
+    # Construct Report
+    report = f"""
+Asset ID: {asset_id}"""
+
+    # Add name if it exists
+    if asset_name is not None:
+        report += f"\nName: {asset_name}"
+        
+    report += f"""
+Biodiversity Rank: #{int(asset_rank) if asset_rank else "N/A"} out of {total_assets}
+-----------------------------------
+Immediate Vicinity:
+  - Shannon Index: {safe_format(exact_shannon)} ({categorize_shannon(exact_shannon)})
+  - Simpson Index: {safe_format(exact_simpson)} ({categorize_simpson(exact_simpson)})
+  - Ecosystems: {', '.join(ecosystems) if ecosystems else "None"}
+Surrounding Area ({radius_km}km radius):
+  - Avg Shannon Index: {safe_format(avg_shannon)} ({categorize_shannon(avg_shannon)})
+  - Avg Simpson Index: {safe_format(avg_simpson)} ({categorize_simpson(avg_simpson)})
+"""
+    # Add distance-weighted averages if hex distances were recorded
+    if 'wavg_shannon' in row:
+        report += f"  - Distance-weighted Avg Shannon Index: {safe_format(wavg_shannon)} ({categorize_shannon(wavg_shannon)})\n"
+        report += f"  - Distance-weighted Avg Simpson Index: {safe_format(wavg_simpson)} ({categorize_simpson(wavg_simpson)})\n"
+    
+    # Add ecosystem coverage if available
+    if has_neighbors:
+        report += "  - % Coverage:\n"
+        for eco in ['coral', 'seagrass', 'cold_water_coral', 'mangrove', 'seamount']:
+            if f"avg_{eco}" in row:
+                report += f"    - {eco.replace('_', ' ').title()}: {safe_format(row[f'avg_{eco}'] * 100)}%\n"
+    
+    return report, asset_rank, asset_name
+
+def generate_asset_report(df, radius_km, metrics=None):
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    with metrics.stage('report.generate'):
+        return format_asset_reports(build_asset_report_table(df), radius_km)
+
+def format_asset_reports(table, radius_km):
+    """
+    Renders the text reports for every row of an asset report table.
+    """
+    report_dict = {}
+    
+    total_assets = len(table)
+    
+    for asset_id, row in table.to_dict('index').items():
+        report, asset_rank, asset_name = format_asset_report(asset_id, row, total_assets, radius_km)
+        report_dict[asset_id] = {
+            "report": report, 
+            "rank": asset_rank,
+            "name": asset_name  # Store the name for use in display
+        }
+    
+    return report_dict
+
+# H3 cells are kept as uint64 internally and only converted to hex strings
+# for display and for building remote queries
+H3_RESOLUTION = 6
+
+# Mean Earth radius used for great-circle distances
+EARTH_RADIUS_KM = 6371.0088
+
+class HexNeighbors(NamedTuple):
+    """
+    Neighbor sets for every asset in CSR layout: the cells around asset i
+    are cells[offsets[i]:offsets[i + 1]], and distances holds the distance
+    in km from the asset to each of those cells' centroids.
+    """
+    cells: np.ndarray
+    offsets: np.ndarray
+    distances: np.ndarray
+    
+    def counts(self):
+        return np.diff(self.offsets)
+    
+    def row(self, i):
+        return self.cells[self.offsets[i]:self.offsets[i + 1]]
+
+def cells_to_str(cells):
+    """
+    Converts an array of uint64 H3 cells to their hex string form.
+    """
+    return np.array([h3.int_to_str(int(c)) for c in cells], dtype=object)
+
+def str_to_cells(hex_strings):
+    """
+    Converts H3 hex strings to an array of uint64 cells.
+    """
+    return np.array([int(h, 16) for h in hex_strings], dtype=np.uint64)
+
+def latlng_to_cells(lat, lon, resolution=H3_RESOLUTION):
+    """
+    Indexes latitude/longitude arrays to uint64 H3 cells.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    return np.fromiter(
+        (h3_int.latlng_to_cell(a, b, resolution) for a, b in zip(lat.tolist(), lon.tolist())),
+        dtype=np.uint64,
+        count=len(lat)
+    )
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in km between arrays of points given in degrees.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def cell_centroids(cells):
+    """
+    Returns the centroid latitude and longitude arrays of uint64 H3 cells.
+    """
+    centroids = np.array([h3_int.cell_to_latlng(int(c)) for c in cells], dtype=np.float64).reshape(-1, 2)
+    return centroids[:, 0], centroids[:, 1]
+
+def rings_for_radius(cells, distance_km):
+    """
+    Returns, for every cell, the grid disk size (in rings) needed to contain
+    every cell whose centroid lies within distance_km of any point inside
+    that cell, based on the local centroid spacing.
+    """
+    lat, lon = cell_centroids(cells)
+    spacing = np.empty(len(cells), dtype=np.float64)
+    for i, c in enumerate(cells):
+        ring_lat, ring_lon = cell_centroids(h3_int.grid_ring(int(c), 1))
+        spacing[i] = haversine_km(lat[i], lon[i], ring_lat, ring_lon).min()
+    
+    # Cells outside a k-ring disk are at least (k + 1) * spacing * sqrt(3) / 2
+    # from its center, and an asset is at most spacing / sqrt(3) from its own
+    # cell's centroid. One extra ring absorbs grid distortion at large radii.
+    reach = distance_km + spacing / np.sqrt(3)
+    return np.ceil(reach / (spacing * np.sqrt(3) / 2)).astype(np.int64)
+
+def grid_disks(cells, lat, lon, distance_km):
+    """
+    Computes, as a HexNeighbors CSR structure, the cells whose centroid lies
+    within distance_km of every asset. Each distinct asset cell is expanded
+    to its minimal covering disk only once, and the disk's corners are then
+    trimmed per asset with an exact haversine distance.
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    
+    unique_cells, inverse = np.unique(cells, return_inverse=True)
+    num_rings = rings_for_radius(unique_cells, distance_km)
+    disks = [h3_int.grid_disk(int(c), int(k)) for c, k in zip(unique_cells, num_rings)]
+    
+    disk_sizes = np.fromiter((len(d) for d in disks), dtype=np.int64, count=len(disks))
+    disk_offsets = np.concatenate(([0], np.cumsum(disk_sizes)))
+    unique_flat = np.concatenate(disks).astype(np.uint64) if disks else np.empty(0, dtype=np.uint64)
+    
+    # Centroids of every distinct candidate cell
+    candidate_cells, candidate_inverse = np.unique(unique_flat, return_inverse=True)
+    candidate_lat, candidate_lon = cell_centroids(candidate_cells)
+    
+    # Gather each asset's disk from the flat array of unique disks
+    counts = disk_sizes[inverse]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    starts = np.repeat(disk_offsets[:-1][inverse], counts)
+    within = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+    flat_index = starts + within
+    asset_index = np.repeat(np.arange(len(cells)), counts)
+    
+    # Keep only cells within the radius (and always the asset's own cell)
+    candidate = candidate_inverse[flat_index]
+    distances = haversine_km(lat[asset_index], lon[asset_index], candidate_lat[candidate], candidate_lon[candidate])
+    keep = (distances <= distance_km) | (unique_flat[flat_index] == cells[asset_index])
+    
+    kept_counts = np.bincount(asset_index[keep], minlength=len(cells))
+    return HexNeighbors(
+        unique_flat[flat_index[keep]],
+        np.concatenate(([0], np.cumsum(kept_counts))),
+        distances[keep].astype(np.float32)
+    )
+
+# Number of asset rows read and indexed at a time
+ASSET_CHUNK_ROWS = 50_000
+
+# Possible column name variations in uploaded asset files
+LAT_COLUMNS = {'latitude', 'lat'}
+LON_COLUMNS = {'longitude', 'long', 'lon'}
+ASSET_ID_COLUMNS = {'asset_id', 'id', 'assetid'}
+NAME_COLUMNS = {'name', 'asset_name', 'title', 'label'}
+
+def resolve_asset_columns(columns):
+    """
+    Matches the file's columns (case insensitive) against the known aliases
+    and returns the actual lat, lon, asset_id and name column names.
+    Raises ValueError if latitude or longitude cannot be found.
+    """
+    lowered = {col.lower(): col for col in columns}
+    
+    def find(aliases):
+        return next((lowered[col] for col in lowered if col in aliases), None)
+    
+    lat_col, lon_col = find(LAT_COLUMNS), find(LON_COLUMNS)
+    if not lat_col or not lon_col:
+        raise ValueError("Error: The file must contain 'latitude' and 'longitude' (or 'lat' and 'long') columns.")
+    
+    return lat_col, lon_col, find(ASSET_ID_COLUMNS), find(NAME_COLUMNS)
+
+def detect_csv_encoding(uploaded_file, sample_bytes=1024 * 1024):
+    """
+    Sniffs the start of a CSV file to choose between UTF-8 and ISO-8859-1,
+    so a Latin-1 file is normally read once, in the right encoding.
+    """
+    import codecs
+    
+    sample = uploaded_file.read(sample_bytes)
+    uploaded_file.seek(0)
+    if isinstance(sample, str):
+        return "utf-8"  # Already decoded text stream
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "ISO-8859-1"
+
+def read_csv_frames(uploaded_file, chunk_rows=ASSET_CHUNK_ROWS):
+    """
+    Streams a CSV file as DataFrames in the sniffed encoding. If a later
+    chunk turns out not to be UTF-8 after all, the stream restarts as
+    ISO-8859-1 after the rows already yielded instead of replacing the
+    undecodable characters.
+    """
+    encoding = detect_csv_encoding(uploaded_file)
+    rows_read = 0
+    try:
+        for df in pd.read_csv(uploaded_file, encoding=encoding, chunksize=chunk_rows):
+            rows_read += len(df)
+            yield df
+        return
+    except UnicodeDecodeError:
+        if encoding != "utf-8":
+            raise
+    
+    uploaded_file.seek(0)
+    yield from pd.read_csv(
+        uploaded_file, encoding="ISO-8859-1", chunksize=chunk_rows, skiprows=range(1, rows_read + 1)
+    )
+
+def read_asset_frames(uploaded_file, chunk_rows=ASSET_CHUNK_ROWS):
+    """
+    Yields the raw asset file as DataFrames of at most chunk_rows rows.
+    CSV and Parquet are streamed; Excel has no streaming reader and is
+    loaded once before being split.
+    """
+    file_name = uploaded_file.name.lower()
+    
+    if file_name.endswith('.csv'):
+        yield from read_csv_frames(uploaded_file, chunk_rows)
+    elif file_name.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        
+        for batch in pq.ParquetFile(uploaded_file).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    elif file_name.endswith(('.xls', '.xlsx')):
+        df = pd.read_excel(uploaded_file)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+    else:
+        raise ValueError("Unsupported file format. Use CSV, Parquet or Excel (.xls/.xlsx).")
+
+def iter_asset_frames(uploaded_file, chunk_rows=ASSET_CHUNK_ROWS, on_warning=None, metrics=None):
+    """
+    Streams an asset file as standardized chunks (asset_id, lat, lon and
+    optional name) without H3 indexing. Column aliases are resolved once from
+    the first chunk and sequential IDs continue across chunks.
+    """
+    on_warning = on_warning or logger.warning
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    columns = None
+    next_asset_id = 1
+    
+    for df in metrics.timed('load.parse', read_asset_frames(uploaded_file, chunk_rows)):
+        if columns is None:
+            columns = resolve_asset_columns(df.columns)
+            if not columns[2]:
+                on_warning("No asset ID column found. Adding a sequential ID column.")
+        lat_col, lon_col, asset_id_col, name_col = columns
+        
+        if asset_id_col:
+            asset_ids = df[asset_id_col].to_numpy()
+        else:
+            asset_ids = np.arange(next_asset_id, next_asset_id + len(df))
+            next_asset_id += len(df)
+        
+        # Create a standardized DataFrame with consistent column names
+        result_columns = {
+            'asset_id': asset_ids,
+            'lat': df[lat_col].to_numpy(),
+            'lon': df[lon_col].to_numpy()
+        }
+        
+        # Add name column if it exists
+        if name_col:
+            result_columns['name'] = df[name_col].to_numpy()
+        
+        yield pd.DataFrame(result_columns)
+
+def index_asset_frame(df, distance_km=50, metrics=None):
+    """
+    Adds the H3 index (resolution 6) to a standardized asset chunk and computes
+    the surrounding hexagons within distance_km. Returns (DataFrame, HexNeighbors).
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    lat = df['lat'].to_numpy()
+    lon = df['lon'].to_numpy()
+    
+    with metrics.stage('load.h3'):
+        # Compute H3 index at resolution 6 over the coordinate arrays
+        h3_index = latlng_to_cells(lat, lon)
+        
+        # Compute surrounding H3 hexagons within the given distance
+        neighbors = grid_disks(h3_index, lat, lon, distance_km)
+    
+    df = df.copy()
+    df.insert(3, 'h3_index', h3_index)
+    return df, neighbors
+
+def iter_asset_chunks(uploaded_file, distance_km=50, chunk_rows=ASSET_CHUNK_ROWS, on_warning=None, metrics=None):
+    """
+    Streams an asset file as standardized chunks. Every chunk from
+    iter_asset_frames is indexed to H3 cells and yielded as
+    (asset DataFrame, HexNeighbors), so memory stays bounded by chunk_rows
+    however large the file is.
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    for df in iter_asset_frames(uploaded_file, chunk_rows, on_warning, metrics):
+        yield index_asset_frame(df, distance_km, metrics)
+
+def concat_hex_neighbors(neighbor_sets):
+    """
+    Concatenates HexNeighbors from consecutive chunks into one CSR structure.
+    """
+    neighbor_sets = list(neighbor_sets)
+    if not neighbor_sets:
+        return HexNeighbors(np.empty(0, dtype=np.uint64), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.float32))
+    
+    cells = np.concatenate([n.cells for n in neighbor_sets])
+    counts = np.concatenate([n.counts() for n in neighbor_sets])
+    distances = np.concatenate([n.distances for n in neighbor_sets])
+    return HexNeighbors(cells, np.concatenate(([0], np.cumsum(counts))), distances)
+
+# Function to load and process asset data
+def load_and_process_asset_data(uploaded_file, distance_km=50, on_warning=None, metrics=None):
+    """
+    Loads asset data from a file path or file object, verifies required columns
+    (case insensitive), and adds an H3 index (resolution 6) column based on
+    latitude and longitude. Also computes surrounding H3 indexes within a
+    specified distance.
+    
+    Returns the asset DataFrame (h3_index as uint64) and the neighbor sets as
+    HexNeighbors. Raises ValueError if the file cannot be used.
+    """
+    if isinstance(uploaded_file, (str, os.PathLike)):
+        with open(uploaded_file, "rb") as asset_file:
+            return load_and_process_asset_data(asset_file, distance_km, on_warning, metrics)
+    
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    chunks = list(iter_asset_chunks(uploaded_file, distance_km, on_warning=on_warning, metrics=metrics))
+    if not chunks:
+        raise ValueError("The uploaded file contains no assets.")
+    
+    with metrics.stage('load.concat'):
+        result_df = pd.concat([df for df, _ in chunks], ignore_index=True)
+        neighbors = concat_hex_neighbors(n for _, n in chunks)
+    
+    return result_df, neighbors
+
+# HUB Ocean Ocean Sensitive Areas dataset
+OSA_DATASET_ID = "468bef0c-5934-44e6-bd3e-5a60a0b326b6"
+
+# Maximum number of hex6 values sent in a single remote query
+HEX_QUERY_CHUNK_SIZE = 500
+
+# Set to True once the ODP table query language accepts `hex6 in (...)`
+ODP_SUPPORTS_IN = False
+
+# Concurrency and retry settings for remote OSA queries
+DEFAULT_QUERY_WORKERS = 4
+QUERY_MAX_RETRIES = 3
+QUERY_RETRY_BACKOFF_S = 1.0
+
+# Local on-disk cache of OSA rows keyed by (dataset UUID, hex6)
+OSA_CACHE_PATH = os.environ.get(
+    "OSA_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "osa", "osa_hex_cache.sqlite")
+)
+OSA_CACHE_TTL_S = 7 * 24 * 3600
+OSA_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+class OsaHexCache:
+    """
+    SQLite-backed cache of OSA query results, one entry per (dataset, hex6).
+    Hexes without any OSA rows are cached too, so they are not re-queried.
+    Entries expire after ttl_s seconds and the least recently used entries
+    are evicted once the stored payload exceeds max_bytes.
+    """
+    def __init__(self, path=OSA_CACHE_PATH, ttl_s=OSA_CACHE_TTL_S, max_bytes=OSA_CACHE_MAX_BYTES):
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Several CLI worker processes may share the same cache file
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS hex_rows (
+                dataset_id TEXT NOT NULL,
+                hex6 TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                size INTEGER NOT NULL,
+                payload BLOB NOT NULL,
+                PRIMARY KEY (dataset_id, hex6)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS hex_rows_lru ON hex_rows (last_used)")
+        self._conn.commit()
+    
+    def lookup(self, dataset_id, hex6_array):
+        """
+        Returns (cached_rows, missing_hexes): a DataFrame of all cached rows
+        for the requested hexes, or None if there are none, and the list of
+        hexes that are absent or expired and must be fetched remotely.
+        """
+        now = time.time()
+        found = {}
+        
+        with self._lock:
+            # Stay well below SQLite's limit on bound parameters
+            for i in range(0, len(hex6_array), 900):
+                chunk = hex6_array[i:i + 900]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT hex6, payload FROM hex_rows "
+                    f"WHERE dataset_id = ? AND fetched_at >= ? AND hex6 IN ({placeholders})",
+                    [dataset_id, now - self.ttl_s, *chunk]
+                ).fetchall()
+                found.update(rows)
+            
+            self._conn.executemany(
+                "UPDATE hex_rows SET last_used = ? WHERE dataset_id = ? AND hex6 = ?",
+                [(now, dataset_id, h) for h in found]
+            )
+            self._conn.commit()
+        
+        missing = [h for h in hex6_array if h not in found]
+        records = [record for payload in found.values() for record in pickle.loads(payload)]
+        cached_rows = pd.DataFrame.from_records(records) if records else None
+        
+        return cached_rows, missing
+    
+    def store(self, dataset_id, hex6_array, rows_df):
+        """
+        Stores the rows fetched for the given hexes, including empty entries
+        for hexes that returned no rows.
+        """
+        now = time.time()
+        records_by_hex = {h: [] for h in hex6_array}
+        if rows_df is not None:
+            for record in rows_df.to_dict("records"):
+                records_by_hex.setdefault(record["hex6"], []).append(record)
+        
+        entries = []
+        for h, records in records_by_hex.items():
+            payload = pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL)
+            entries.append((dataset_id, h, now, now, len(payload), payload))
+        
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO hex_rows VALUES (?, ?, ?, ?, ?, ?)", entries
+            )
+            self._conn.commit()
+    
+    def evict(self):
+        """
+        Drops expired entries, then the least recently used ones until the
+        cache fits within max_bytes.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM hex_rows WHERE fetched_at < ?", (time.time() - self.ttl_s,))
+            
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM hex_rows").fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                freed = 0
+                stale = []
+                for dataset_id, hex6, size in self._conn.execute(
+                    "SELECT dataset_id, hex6, size FROM hex_rows ORDER BY last_used"
+                ):
+                    if freed >= excess:
+                        break
+                    stale.append((dataset_id, hex6))
+                    freed += size
+                self._conn.executemany(
+                    "DELETE FROM hex_rows WHERE dataset_id = ? AND hex6 = ?", stale
+                )
+            self._conn.commit()
+    
+    def clear(self):
+        """
+        Removes every cached entry.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM hex_rows")
+            self._conn.commit()
+
+@functools.lru_cache(maxsize=None)
+def get_hex_cache():
+    """
+    Opens the on-disk OSA hex cache once per process.
+    """
+    return OsaHexCache()
+
+def hex6_range(cell):
+    """
+    Returns the (lowest, highest) hex6 strings of the resolution 6 children
+    of a coarser cell. All children share the parent's leading digits, so
+    they form one contiguous range in the fixed-width hex6 string order.
+    """
+    resolution = h3_int.get_resolution(cell)
+    lowest = int(h3_int.cell_to_center_child(cell, H3_RESOLUTION))
+    
+    # Set the child digits below the parent's resolution to their maximum (6)
+    highest = lowest
+    for digit in range(resolution + 1, H3_RESOLUTION + 1):
+        highest |= 6 << (3 * (15 - digit))
+    
+    return h3.int_to_str(int(lowest)), h3.int_to_str(int(highest))
+
+def build_hex_query(hex6_array):
+    """
+    Builds a filter expression matching any of the given hex6 values.
+    Cells coarser than resolution 6 (from compaction) are matched as a range
+    covering all of their resolution 6 children.
+    """
+    exact = [h for h in hex6_array if h3.get_resolution(h) == H3_RESOLUTION]
+    ranges = [hex6_range(h3.str_to_int(h)) for h in hex6_array if h3.get_resolution(h) != H3_RESOLUTION]
+    
+    terms = [f'(hex6 >= "{lowest}" AND hex6 <= "{highest}")' for lowest, highest in ranges]
+    if exact and ODP_SUPPORTS_IN:
+        values = ", ".join(f'"{h}"' for h in exact)
+        terms.insert(0, f"hex6 in ({values})")
+    else:
+        terms = [f'hex6 == "{h}"' for h in exact] + terms
+    
+    return " OR ".join(terms)
+
+def compact_hexes(hex6_array):
+    """
+    Replaces every complete set of sibling hex6 values with their parent
+    cell, recursively, and returns the compacted cells as hex strings.
+    """
+    return [h3.int_to_str(int(c)) for c in h3_int.compact_cells(str_to_cells(hex6_array))]
+
+def expand_hexes(compact_array):
+    """
+    Expands compacted cells back to their resolution 6 hex6 values.
+    """
+    cells = str_to_cells(compact_array)
+    return cells_to_str(h3_int.uncompact_cells(cells, H3_RESOLUTION)).tolist()
+
+def chunk_hexes(hex6_array, chunk_size=HEX_QUERY_CHUNK_SIZE):
+    """
+    Splits a list of hex6 values into size-bounded chunks for querying.
+    """
+    return [hex6_array[i:i + chunk_size] for i in range(0, len(hex6_array), chunk_size)]
+
+def build_asset_hex_index(df, neighbors):
+    """
+    Builds the local hex -> asset index as one row per (asset, hex) pair,
+    flagging whether the hex is a neighbor or the asset's own location and
+    recording the distance from the asset to the hex centroid.
+    Assets are referenced by position in df and hexes are uint64 cells.
+    """
+    h3_index = df['h3_index'].to_numpy(dtype=np.uint64)
+    counts = neighbors.counts()
+    asset_order = np.repeat(np.arange(len(df), dtype=np.int32), counts)
+    
+    # Make sure each asset's own hex is present even if its disk omits it
+    own_lat, own_lon = cell_centroids(h3_index)
+    own_distance = haversine_km(df['lat'].to_numpy(), df['lon'].to_numpy(), own_lat, own_lon)
+    
+    asset_order = np.concatenate((np.arange(len(df), dtype=np.int32), asset_order))
+    hex_id = np.concatenate((h3_index, neighbors.cells))
+    hex_distance = np.concatenate((own_distance.astype(np.float32), neighbors.distances))
+    
+    index_df = pd.DataFrame({'asset_order': asset_order, 'hex_id': hex_id, 'hex_distance_km': hex_distance})
+    index_df = index_df.drop_duplicates(subset=['asset_order', 'hex_id']).sort_values('asset_order', kind='stable')
+    
+    order = index_df['asset_order'].to_numpy()
+    index_df['is_neighbor'] = index_df['hex_id'].to_numpy() != h3_index[order]
+    
+    return index_df.reset_index(drop=True)
+
+def fetch_chunk_with_retry(osa_data, chunk, metrics=None):
+    """
+    Runs the query for one chunk of hex6 values, retrying with exponential
+    backoff on failure. Safe to call from worker threads.
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    query = build_hex_query(chunk)
+    for attempt in range(QUERY_MAX_RETRIES + 1):
+        start = time.perf_counter()
+        try:
+            # Consume every batch the cursor returns, not only the first one
+            frames = list(osa_data.select(query).dataframes())
+        except Exception:
+            if attempt == QUERY_MAX_RETRIES:
+                metrics.record_query(time.perf_counter() - start, 0, 0, attempt + 1, failed=True)
+                raise
+            time.sleep(QUERY_RETRY_BACKOFF_S * 2 ** attempt)
+            continue
+        
+        metrics.record_query(
+            time.perf_counter() - start,
+            sum(len(frame) for frame in frames),
+            sum(int(frame.memory_usage(deep=True).sum()) for frame in frames),
+            attempt + 1
+        )
+        return frames
+
+def fetch_osa_hexes(osa_data, hex6_array, max_workers=DEFAULT_QUERY_WORKERS, cache=None, compact=False,
+                    on_progress=None, on_warning=None, metrics=None):
+    """
+    Queries the OSA table once per chunk of unique hex6 values, running up to
+    max_workers chunks concurrently over the shared table handle. Returns
+    all matching rows as a single DataFrame (one entry per OSA row, or None)
+    and the list of requested hexes whose chunk failed, which must not be
+    treated as empty. Successfully fetched chunks are written to the cache
+    when one is given.
+    
+    With compact=True the hexes are first compacted to coarser parent cells,
+    each queried as a single hex6 range, and the rows are filtered locally
+    back to the requested resolution 6 hexes.
+    
+    on_progress receives the completed fraction and on_warning the message
+    for each failed chunk; both are called from the calling thread.
+    """
+    on_warning = on_warning or logger.warning
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    if compact:
+        chunks = chunk_hexes(compact_hexes(hex6_array))
+        covered_hexes = [expand_hexes(chunk) for chunk in chunks]
+    else:
+        chunks = chunk_hexes(hex6_array)
+        covered_hexes = chunks
+    chunk_results = []
+    failed_hexes = set()
+    
+    with metrics.stage('query.remote'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(fetch_chunk_with_retry, osa_data, chunk, metrics): i
+            for i, chunk in enumerate(chunks)
+        }
+        
+        # Update progress as chunks complete rather than in submission order
+        for completed, future in enumerate(as_completed(futures), start=1):
+            if on_progress is not None:
+                on_progress(completed / len(chunks))
+            i = futures[future]
+            try:
+                frames = future.result()
+            except Exception as e:
+                on_warning(f"Error querying hex chunk {i + 1} of {len(chunks)}: {e}")
+                failed_hexes.update(covered_hexes[i])
+                continue
+            
+            chunk_results.extend(frames)
+            if cache is not None:
+                cache.store(OSA_DATASET_ID, covered_hexes[i], pd.concat(frames, ignore_index=True) if frames else None)
+    
+    failed_hexes = [h for h in hex6_array if h in failed_hexes]
+    if not chunk_results:
+        return None, failed_hexes
+    
+    with metrics.stage('query.concat'):
+        osa_rows = pd.concat(chunk_results, ignore_index=True)
+        if compact:
+            osa_rows = osa_rows[osa_rows['hex6'].isin(hex6_array)].reset_index(drop=True)
+    
+    return osa_rows, failed_hexes
+
+class OsaResults(NamedTuple):
+    """
+    Normalized query results. Each OSA row is stored once in hex_rows, links
+    holds one compact (asset, hex, is_neighbor) entry per match, and assets
+    holds the asset_id (and name) for every asset position used in links.
+    queried_hexes lists every hex the run retrieved, including hexes without
+    any OSA rows, so an incremental rerun knows what it need not re-query;
+    hexes whose query failed are left out so they are retried.
+    
+    The tables use a compact typed schema (see compact_osa_rows): uint64
+    hex IDs, int32 asset positions, a boolean is_neighbor, float32 indices
+    and Arrow-backed or categorical text.
+    """
+    hex_rows: pd.DataFrame
+    links: pd.DataFrame
+    assets: pd.DataFrame
+    queried_hexes: np.ndarray = None
+    
+    def record_count(self):
+        """
+        Number of rows in the wide per-asset view, without building it.
+        """
+        rows_per_hex = self.hex_rows['hex_id'].value_counts()
+        return int(self.links['hex_id'].map(rows_per_hex).sum())
+    
+    def wide(self, columns=None, neighbor_labels=True):
+        """
+        Joins the normalized tables back into one row per (asset, OSA row),
+        in the layout of the original per-asset query results. Pass columns
+        to join only the OSA columns that are actually needed. is_neighbor
+        is a categorical of 'Asset'/'Neighbor' labels for display and export,
+        or stays boolean with neighbor_labels=False.
+        """
+        osa_columns = [col for col in self.hex_rows.columns if col != 'hex_id']
+        if columns is not None:
+            osa_columns = [col for col in osa_columns if col in columns]
+        
+        hex_rows = self.hex_rows[osa_columns + ['hex_id']].reset_index(drop=True)
+        hex_rows['osa_row'] = hex_rows.index
+        hex_rows = hex_rows[hex_rows['hex_id'].isin(self.links['hex_id'])]
+        
+        results_df = hex_rows.merge(self.links, on='hex_id', how='inner')
+        results_df = results_df.sort_values(['asset_order', 'osa_row'], kind='stable')
+        if neighbor_labels:
+            results_df['is_neighbor'] = pd.Categorical.from_codes(
+                results_df['is_neighbor'].to_numpy(dtype=np.int8), NEIGHBOR_LABELS
+            )
+        
+        # Taking from the asset columns keeps categorical names as codes
+        order = results_df['asset_order'].to_numpy()
+        for col in self.assets.columns:
+            results_df[col] = self.assets[col].array.take(order)
+        
+        link_columns = ['is_neighbor', 'hex_distance_km'] if 'hex_distance_km' in self.links.columns else ['is_neighbor']
+        return results_df[osa_columns + link_columns + list(self.assets.columns)].reset_index(drop=True)
+
+# Labels of the is_neighbor flag in wide views
+NEIGHBOR_LABELS = ['Asset', 'Neighbor']
+
+def compact_text(values):
+    """
+    Stores a column of Python strings compactly: as categories when values
+    repeat, otherwise as Arrow-backed strings when pyarrow is installed.
+    Columns holding anything other than strings are returned unchanged.
+    """
+    if values.dtype != object or pd.api.types.infer_dtype(values, skipna=True) != 'string':
+        return values
+    if values.nunique() <= len(values) // 2:
+        return values.astype('category')
+    try:
+        return values.astype('string[pyarrow]')
+    except ImportError:
+        return values
+
+def compact_osa_rows(osa_rows):
+    """
+    Converts OSA rows to the compact result schema: the float64 index and
+    ecosystem coverage columns become float32 (the reports show three
+    decimals) and text columns such as hex6 are stored by compact_text.
+    """
+    converted = {}
+    for col in osa_rows.columns:
+        values = osa_rows[col]
+        if col in REPORT_COLUMNS and values.dtype == np.float64:
+            converted[col] = values.astype(np.float32)
+        elif values.dtype == object:
+            converted[col] = compact_text(values)
+    return osa_rows.assign(**converted)
+
+def compact_assets(assets):
+    """
+    Stores the asset names by compact_text.
+    """
+    if 'name' in assets.columns:
+        assets = assets.assign(name=compact_text(assets['name']))
+    return assets
+
+def build_osa_results(osa_rows, asset_hex_index, df, queried_hexes=None):
+    """
+    Builds the normalized OsaResults from the unique OSA rows, keeping only
+    the asset/hex links that actually matched a row.
+    """
+    hex_rows = osa_rows.reset_index(drop=True)
+    if 'hex_id' not in hex_rows.columns:
+        hex_rows['hex_id'] = str_to_cells(hex_rows['hex6'])
+    hex_rows = compact_osa_rows(hex_rows)
+    
+    links = asset_hex_index[asset_hex_index['hex_id'].isin(hex_rows['hex_id'])].reset_index(drop=True)
+    
+    asset_columns = ['asset_id', 'name'] if 'name' in df.columns else ['asset_id']
+    assets = compact_assets(df[asset_columns].reset_index(drop=True))
+    
+    return OsaResults(hex_rows, links, assets, queried_hexes)
+
+# Number of asset/hex links expanded at a time when exporting results
+EXPORT_CHUNK_LINKS = 100_000
+
+# Download formats for query results: file name and MIME type
+EXPORT_FORMATS = {
+    "CSV": ("osa_results.csv", "text/csv"),
+    "CSV (gzip)": ("osa_results.csv.gz", "application/gzip"),
+    "Parquet": ("osa_results.parquet", "application/vnd.apache.parquet")
+}
+
+def filter_results(results, view="All", asset_filter=""):
+    """
+    Restricts the links of OsaResults to asset rows, neighbor rows and/or
+    assets whose ID contains asset_filter, without expanding any rows.
+    """
+    links = results.links
+    if view == "Asset rows":
+        links = links[~links['is_neighbor']]
+    elif view == "Neighbor rows":
+        links = links[links['is_neighbor']]
+    
+    if asset_filter:
+        matches = results.assets['asset_id'].astype(str).str.contains(asset_filter, regex=False)
+        links = links[links['asset_order'].isin(np.flatnonzero(matches.to_numpy()))]
+    
+    return results._replace(links=links.reset_index(drop=True))
+
+def iter_wide_chunks(results, chunk_links=EXPORT_CHUNK_LINKS):
+    """
+    Yields the wide per-asset view in order, expanding at most chunk_links
+    links at a time.
+    """
+    for start in range(0, len(results.links), chunk_links):
+        yield results._replace(links=results.links.iloc[start:start + chunk_links]).wide()
+
+def geometries_to_wkt(df):
+    """
+    Converts columns holding geometry objects to WKT strings so they can be
+    written to Parquet.
+    """
+    for col in df.columns[df.dtypes == object]:
+        sample = df[col].dropna()
+        if not sample.empty and hasattr(sample.iloc[0], 'wkt'):
+            df[col] = df[col].map(lambda geom: geom.wkt if geom is not None else None)
+    return df
+
+def export_results(results, export_format="CSV"):
+    """
+    Writes the wide per-asset view to a temporary file chunk by chunk and
+    returns it rewound for reading, so the full export is never held in
+    memory.
+    """
+    import gzip
+    import io
+    import tempfile
+    
+    out = tempfile.TemporaryFile()
+    
+    if export_format == "Parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        writer = None
+        for chunk_df in iter_wide_chunks(results):
+            table = pa.Table.from_pandas(geometries_to_wkt(chunk_df), preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(out, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        if writer is not None:
+            writer.close()
+    else:
+        binary = gzip.GzipFile(fileobj=out, mode="wb") if export_format == "CSV (gzip)" else out
+        text = io.TextIOWrapper(binary, encoding="utf-8", newline="")
+        for i, chunk_df in enumerate(iter_wide_chunks(results)):
+            chunk_df.to_csv(text, index=False, header=i == 0)
+        text.flush()
+        text.detach()
+        if binary is not out:
+            binary.close()
+    
+    # Hand back a plain read-only BufferedReader on the same (already
+    # unlinked) file, as download widgets do not accept BufferedRandom
+    out.flush()
+    export = os.fdopen(os.dup(out.fileno()), "rb")
+    out.close()
+    export.seek(0)
+    return export
+
+def fingerprint_results(results):
+    """
+    Hashes the parts of OsaResults that the reports depend on, so cached
+    reports can be tied to the exact results they were generated from.
+    """
+    digest = hashlib.sha1()
+    report_columns = [col for col in ['hex_id', *REPORT_COLUMNS] if col in results.hex_rows.columns]
+    
+    for frame in (results.hex_rows[report_columns], results.links, results.assets):
+        digest.update(pd.util.hash_pandas_object(frame, index=False).to_numpy().tobytes())
+    
+    return digest.hexdigest()
+
+def asset_signatures(results):
+    """
+    One hash per asset over its links (hex, status and distance) and name,
+    used to tell which assets' report rows an incremental rerun changed.
+    """
+    order = results.links['asset_order'].to_numpy()
+    link_columns = results.links.drop(columns='asset_order').assign(
+        **{col: results.assets[col].to_numpy()[order] for col in results.assets.columns}
+    )
+    hashes = pd.util.hash_pandas_object(link_columns, index=False).to_numpy()
+    return pd.Series(hashes).groupby(link_columns['asset_id'].to_numpy(), sort=False).sum()
+
+def update_asset_report_table(table, previous_signatures, results, signatures=None):
+    """
+    Updates an asset report table in place of a full rebuild after an
+    incremental rerun: rows of removed assets are dropped, only new or
+    changed assets are recomputed and the ranks are refreshed.
+    """
+    if signatures is None:
+        signatures = asset_signatures(results)
+    
+    unchanged = signatures.eq(previous_signatures.reindex(signatures.index))
+    changed = signatures.index[~unchanged.to_numpy()]
+    kept = table[table.index.isin(signatures.index) & ~table.index.isin(changed)]
+    
+    frames = [kept]
+    if len(changed):
+        changed_orders = np.flatnonzero(results.assets['asset_id'].isin(changed).to_numpy())
+        changed_links = results.links[results.links['asset_order'].isin(changed_orders)]
+        df = results._replace(links=changed_links).wide(columns=REPORT_COLUMNS, neighbor_labels=False)
+        frames.append(build_asset_report_table(df))
+    
+    table = pd.concat(frames)
+    table['rank'] = table['mean_shannon'].rank(ascending=False)
+    return table.sort_values('mean_shannon', ascending=False, kind='stable')
+
+@functools.lru_cache(maxsize=None)
+def get_osa_table():
+    """
+    Connects to the ODP client once per process and returns the dataset's
+    display name and the OSA table handle, which is shared by all query
+    workers (and Streamlit reruns).
+    """
+    # Imported here so loading the pipeline does not pull in the ODP SDK
+    from odp.client import OdpClient
+    
+    # Connect to ODP client
+    client = OdpClient()
+    
+    # Request the dataset from the catalog using the UUID
+    osa_table_dataset = client.catalog.get((OSA_DATASET_ID))
+    osa_data = client.table_v2(osa_table_dataset)
+    
+    return osa_table_dataset.metadata.display_name, osa_data
+
+def fetch_hex_rows(hex6_array, max_workers=DEFAULT_QUERY_WORKERS, cache=None, compact=False,
+                   on_progress=None, on_warning=None, metrics=None):
+    """
+    Collects the OSA rows of the given hexes: serves cached hexes locally and
+    fetches the rest remotely. Returns (rows or None, cache hits, cache
+    misses, hexes whose remote query failed).
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    if cache is not None:
+        with metrics.stage('query.cache'):
+            cached_rows, missing_hexes = cache.lookup(OSA_DATASET_ID, hex6_array)
+    else:
+        cached_rows, missing_hexes = None, hex6_array
+    
+    fetched_rows, failed_hexes = None, []
+    if missing_hexes:
+        with metrics.stage('query.connect'):
+            _, osa_data = get_osa_table()
+        fetched_rows, failed_hexes = fetch_osa_hexes(
+            osa_data, missing_hexes, max_workers, cache, compact, on_progress, on_warning, metrics
+        )
+        if cache is not None:
+            with metrics.stage('query.cache'):
+                cache.evict()
+    
+    hits, misses = len(hex6_array) - len(missing_hexes), len(missing_hexes)
+    
+    with metrics.stage('query.concat'):
+        row_frames = [rows for rows in (cached_rows, fetched_rows) if rows is not None]
+        osa_rows = pd.concat(row_frames, ignore_index=True) if row_frames else None
+    return osa_rows, hits, misses, failed_hexes
+
+def succeeded_hexes(hex_ids, failed_hexes):
+    """
+    The uint64 hexes of hex_ids whose rows were actually retrieved, so hexes
+    of failed chunks are re-queried by the next incremental run.
+    """
+    if not failed_hexes:
+        return hex_ids
+    return hex_ids[~np.isin(hex_ids, str_to_cells(failed_hexes))]
+
+def query_osa_chunk(df, neighbors, max_workers=DEFAULT_QUERY_WORKERS, cache=None, compact=False,
+                    on_progress=None, on_warning=None, metrics=None):
+    """
+    Runs the query stage for one batch of assets: serves cached hexes locally,
+    fetches the rest remotely and links the rows to every asset claiming them.
+    Returns (OsaResults or None, cache hits, cache misses).
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    
+    # Map every hex back to the assets that claim it
+    with metrics.stage('query.index'):
+        asset_hex_index = build_asset_hex_index(df, neighbors)
+        
+        # Query each unique hex exactly once, however many assets share it
+        hex_ids = np.unique(asset_hex_index['hex_id'].to_numpy())
+    
+    osa_rows, hits, misses, failed_hexes = fetch_hex_rows(
+        cells_to_str(hex_ids).tolist(), max_workers, cache, compact, on_progress, on_warning, metrics
+    )
+    
+    if osa_rows is None or osa_rows.empty:
+        return None, hits, misses
+    
+    with metrics.stage('query.link'):
+        results = build_osa_results(osa_rows, asset_hex_index, df, succeeded_hexes(hex_ids, failed_hexes))
+    return (results if not results.links.empty else None), hits, misses
+
+def update_osa_results(previous, df, neighbors, max_workers=DEFAULT_QUERY_WORKERS, cache=None, compact=False,
+                       on_progress=None, on_warning=None, metrics=None):
+    """
+    Incremental version of query_osa_chunk for what-if reruns after the asset
+    list or radius changed. Hexes covered by the previous OsaResults are
+    reused as they are, rows of hexes no longer covered are dropped and only
+    newly covered hexes are queried. The links are rebuilt for the new assets.
+    Returns (OsaResults or None, reused hexes, cache hits, cache misses).
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    
+    with metrics.stage('query.index'):
+        asset_hex_index = build_asset_hex_index(df, neighbors)
+        hex_ids = np.unique(asset_hex_index['hex_id'].to_numpy())
+        
+        # Results combined from several chunks do not record their empty hexes
+        known_hexes = previous.queried_hexes
+        if known_hexes is None:
+            known_hexes = previous.hex_rows['hex_id'].unique()
+        
+        is_known = np.isin(hex_ids, known_hexes)
+        kept_rows = previous.hex_rows[previous.hex_rows['hex_id'].isin(hex_ids)]
+    
+    new_rows, hits, misses, failed_hexes = fetch_hex_rows(
+        cells_to_str(hex_ids[~is_known]).tolist(), max_workers, cache, compact, on_progress, on_warning, metrics
+    )
+    
+    with metrics.stage('query.concat'):
+        row_frames = [kept_rows]
+        if new_rows is not None and not new_rows.empty:
+            row_frames.append(new_rows.assign(hex_id=str_to_cells(new_rows['hex6'])))
+        osa_rows = pd.concat(row_frames, ignore_index=True)
+    
+    reused = int(is_known.sum())
+    if osa_rows.empty:
+        return None, reused, hits, misses
+    
+    with metrics.stage('query.link'):
+        results = build_osa_results(osa_rows, asset_hex_index, df, succeeded_hexes(hex_ids, failed_hexes))
+    return (results if not results.links.empty else None), reused, hits, misses
+
+def stream_osa_results(asset_chunks, max_workers=DEFAULT_QUERY_WORKERS, use_cache=True, compact=False,
+                       on_progress=None, on_warning=None, metrics=None):
+    """
+    Generator pipeline over iter_asset_chunks: queries each chunk of assets
+    as it is read and yields (OsaResults, cache hits, cache misses),
+    skipping chunks without any results.
+    """
+    cache = get_hex_cache() if use_cache else None
+    
+    for df, neighbors in asset_chunks:
+        results, hits, misses = query_osa_chunk(
+            df, neighbors, max_workers, cache, compact, on_progress, on_warning, metrics
+        )
+        if results is not None:
+            yield results, hits, misses
+
+def stream_results_to_csv(uploaded_file, distance_km, max_workers=DEFAULT_QUERY_WORKERS, use_cache=True,
+                          compact=False, on_progress=None, on_warning=None, metrics=None):
+    """
+    Runs the whole pipeline chunk by chunk and appends the results to a
+    temporary CSV file, so neither the assets nor the results are ever held
+    in memory all at once. Returns the file path, the number of rows written
+    and the cache hit and miss counts. The caller owns the file and deletes
+    it when done; it is removed here if the run fails.
+    """
+    import tempfile
+    
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    handle, path = tempfile.mkstemp(prefix="osa_results_", suffix=".csv")
+    total_rows = 0
+    hits = misses = 0
+    
+    try:
+        with os.fdopen(handle, "w", newline="", encoding="utf-8") as out:
+            asset_chunks = iter_asset_chunks(uploaded_file, distance_km, on_warning=on_warning, metrics=metrics)
+            for results, chunk_hits, chunk_misses in stream_osa_results(
+                asset_chunks, max_workers, use_cache, compact, on_progress, on_warning, metrics
+            ):
+                with metrics.stage('export.csv'):
+                    results_df = results.wide()
+                    results_df.to_csv(out, index=False, header=total_rows == 0)
+                total_rows += len(results_df)
+                hits += chunk_hits
+                misses += chunk_misses
+    except BaseException:
+        os.remove(path)
+        raise
+    
+    return path, total_rows, hits, misses
+
+def concat_results(results_list):
+    """
+    Combines OsaResults from consecutive asset chunks into one, keeping each
+    OSA row once even when neighboring chunks fetched the same hex.
+    """
+    hex_frames, link_frames, asset_frames, queried_frames = [], [], [], []
+    seen_hexes = set()
+    asset_offset = 0
+    
+    for results in results_list:
+        new_rows = ~results.hex_rows['hex_id'].isin(seen_hexes)
+        hex_frames.append(results.hex_rows[new_rows])
+        seen_hexes.update(results.hex_rows['hex_id'].tolist())
+        
+        link_frames.append(results.links.assign(asset_order=results.links['asset_order'] + asset_offset))
+        asset_frames.append(results.assets)
+        asset_offset += len(results.assets)
+        queried_frames.append(results.queried_hexes)
+    
+    if not asset_frames:
+        return None
+    
+    # Chunks built without a queried_hexes list leave it unknown for the whole
+    queried_hexes = None
+    if all(queried is not None for queried in queried_frames):
+        queried_hexes = np.unique(np.concatenate(queried_frames))
+    
+    # Categories differing between chunks fall back to object on concat
+    return OsaResults(
+        compact_osa_rows(pd.concat(hex_frames, ignore_index=True)),
+        pd.concat(link_frames, ignore_index=True),
+        compact_assets(pd.concat(asset_frames, ignore_index=True)),
+        queried_hexes
+    )